@@ -13,23 +13,36 @@
 """
 from __future__ import absolute_import, unicode_literals
 
-import xml.etree.ElementTree
-from xml.etree import cElementTree as ElementTree
-
-import sys
-if sys.version_info.major == 3:
-    from io import StringIO
-    uenc = 'unicode'
-else:
-    from cStringIO import StringIO
-    uenc = 'utf-8'
-
+import xml.etree.ElementTree as ElementTree
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from io import StringIO
+uenc = 'unicode'
+
+import collections
+import concurrent.futures
+import copy
 import datetime
+import hashlib
+import itertools
 import logging
+import mmap
+import os
+import pickle
 from functools import reduce
 logger = logging.getLogger(__file__)
 import re
+import struct
+import threading
 import uuid
+from xml.sax.saxutils import quoteattr
 
 version_info = (1, 1, 0)
 __version__ = '.'.join(str(c) for c in version_info)
@@ -40,6 +53,98 @@ def xsd_now():
     return datetime.datetime.now().isoformat()
 
 DEFAULT_NOW = xsd_now()
+#
+# The XML backends. lxml is used when it is installed, otherwise the
+# standard library's ElementTree (which is accelerated by C in Python 3).
+#
+BACKEND_ETREE = "etree"
+BACKEND_LXML = "lxml"
+DEFAULT_BACKEND = BACKEND_ETREE if lxml_etree is None else BACKEND_LXML
+
+def get_backend(backend=None):
+    '''Return the ElementTree module of a backend
+
+    backend - BACKEND_ETREE, BACKEND_LXML or None for DEFAULT_BACKEND
+    '''
+    backend = backend or DEFAULT_BACKEND
+    if backend == BACKEND_ETREE:
+        return ElementTree
+    if backend == BACKEND_LXML:
+        if lxml_etree is None:
+            raise ImportError("The lxml backend requires lxml to be installed")
+        return lxml_etree
+    raise ValueError("Unknown XML backend '%s'" % backend)
+
+def make_parser(backend=None, target=None):
+    '''Make an incremental XML parser for a backend
+
+    lxml is told to drop comments and processing instructions, as
+    ElementTree does, so that both backends produce the same tree.
+    '''
+    if (backend or DEFAULT_BACKEND) == BACKEND_LXML:
+        return get_backend(backend).XMLParser(
+            target=target, remove_comments=True, remove_pis=True, huge_tree=True)
+    return get_backend(backend).XMLParser(target=target)
+
+if lxml_etree is not None:
+    LXML_USES_NAMESPACE = lxml_etree.XPath("boolean(//@*[namespace-uri() = $uri])")
+RE_XMLNS = re.compile(r'\sxmlns(?::[\w.-]+)?="[^"]*"')
+
+def lxml_to_string(root, ome):
+    '''Write an lxml tree exactly as ElementTree would write it
+
+    root - the root element. ElementTree declares the namespaces used in
+           the tree on it, with the prefixes registered with
+           ElementTree.register_namespace, sorted by prefix.
+    ome - the OME namespace, that of the root element
+
+    lxml writes the tree, which is then patched up as text. This works
+    when all namespaces are declared on the root with the prefixes that
+    ElementTree would use or, for the OME namespace, as the default
+    namespace. None is returned for other trees and for the rare ones
+    whose output differs in ways that can't be patched (empty rather
+    than missing text, carriage returns in text and CDATA).
+    '''
+    xml = lxml_etree.tostring(root, encoding="unicode")
+    root_end = xml.index(">") + 1
+    if "xmlns" in xml[root_end:] or "></" in xml or "&#13;" in xml or \
+            "<![CDATA[" in xml:
+        return None
+    namespace_map = ElementTree._namespace_map
+    ome_prefix = namespace_map.get(ome)
+    default = root.nsmap.get(None)
+    if ome_prefix is None or (default is not None and default != ome):
+        return None
+    used = {ome_prefix: ome}
+    root_uris = set(name[1:].split("}")[0] for name in root.attrib
+                    if name.startswith("{"))
+    for prefix, uri in root.nsmap.items():
+        if prefix is None:
+            continue
+        # text can't hold "<", so "<prefix:" is always a tag. Attributes
+        # are checked with XPath unless the prefix can't be there at all.
+        in_tags = "<%s:" % prefix in xml
+        if not (in_tags or uri in root_uris or
+                (" %s:" % prefix in xml and LXML_USES_NAMESPACE(root, uri=uri))):
+            continue
+        if namespace_map.get(uri) != prefix or (
+                in_tags and default is not None and uri != ome):
+            return None
+        used[prefix] = uri
+    start_tag = RE_XMLNS.sub("", xml[:root_end])
+    start_tag = "<%s:OME%s%s" % (
+        ome_prefix,
+        "".join(' xmlns:%s="%s"' % (prefix, used[prefix]) for prefix in sorted(used)),
+        start_tag[start_tag.index("OME") + 3:])
+    body = xml[root_end:]
+    if default is not None:
+        # every tag is in the default namespace
+        body = body.replace("</", "\0").replace("<", "<%s:" % ome_prefix).replace(
+            "\0", "</%s:" % ome_prefix)
+    # ">" is always escaped in text and attributes so "/>" only ends
+    # empty elements. lxml's escapes are otherwise ElementTree's.
+    return (start_tag + body).replace("/>", " />").replace("&#9;", "&#09;")
+
 #
 # The namespaces
 #
@@ -48,6 +153,9 @@ NS_ORIGINAL_METADATA = "openmicroscopy.org/OriginalMetadata"
 NS_DEFAULT = "http://www.openmicroscopy.org/Schemas/{ns_key}/2016-06"
 NS_RE = r"http://www.openmicroscopy.org/Schemas/(?P<ns_key>.*)/[0-9/-]"
 
+# Size of the slices in which in-memory buffers are fed to the XML parser
+PARSE_CHUNK_SIZE = 1 << 20
+
 default_xml = """<?xml version="1.0" encoding="UTF-8"?>
 <!-- Warning: this comment is an OME-XML metadata block, which contains
 crucial dimensional parameters and other important metadata. Please edit
@@ -105,6 +213,45 @@ DO_XYCTZ = "XYCTZ"
 DO_XYCZT = "XYCZT"
 DO_XYTCZ = "XYTCZ"
 DO_XYTZC = "XYTZC"
+
+DIMENSION_ORDERS = (DO_XYZCT, DO_XYZTC, DO_XYCTZ, DO_XYCZT, DO_XYTCZ, DO_XYTZC)
+#
+# The columns of Pixels.plane_table: the Plane attribute, its numpy type and
+# the value used where the attribute is missing
+#
+PLANE_TABLE_COLUMNS = (
+    ("TheZ", "i8", "-1"),
+    ("TheC", "i8", "-1"),
+    ("TheT", "i8", "-1"),
+    ("DeltaT", "f8", "nan"),
+    ("DeltaTUnit", "U", ""),
+    ("ExposureTime", "f8", "nan"),
+    ("ExposureTimeUnit", "U", ""),
+    ("PositionX", "f8", "nan"),
+    ("PositionXUnit", "U", ""),
+    ("PositionY", "f8", "nan"),
+    ("PositionYUnit", "U", ""),
+    ("PositionZ", "f8", "nan"),
+    ("PositionZUnit", "U", ""),
+)
+#
+# The length units of the OME schema and their size in meters. "um" and the
+# Greek mu are accepted for the micro sign.
+#
+LENGTH_UNITS = {
+    "Ym": 1e24, "Zm": 1e21, "Em": 1e18, "Pm": 1e15, "Tm": 1e12, "Gm": 1e9,
+    "Mm": 1e6, "km": 1e3, "hm": 1e2, "dam": 1e1, "m": 1.0, "dm": 1e-1,
+    "cm": 1e-2, "mm": 1e-3, "\u00b5m": 1e-6, "um": 1e-6, "\u03bcm": 1e-6,
+    "nm": 1e-9, "pm": 1e-12, "fm": 1e-15, "am": 1e-18, "zm": 1e-21,
+    "ym": 1e-24, "\u00c5": 1e-10, "thou": 2.54e-5, "li": 2.54e-3 / 12,
+    "in": 2.54e-2, "ft": 0.3048, "yd": 0.9144, "mi": 1609.344,
+    "ua": 149597870700.0, "ly": 9460730472580800.0, "pc": 3.0856776e16,
+    "pt": 2.54e-2 / 72}
+#
+# Length units that aren't lengths and so can't be converted. Positions
+# without a unit are in the schema default, the reference frame.
+#
+UNCONVERTED_LENGTH_UNITS = ("pixel", "reference frame")
 #
 # Original metadata corresponding to TIFF tags
 # The text for these can be found in
@@ -251,16 +398,71 @@ def split_qn(qn):
     return m.group(1), m.group(2) if m else None
 
 def get_namespaces(node):
-    '''Get top-level XML namespaces from a node.'''
-    ns_lib = {'ome': None, 'sa': None, 'spw': None}
+    '''Get top-level XML namespaces from a node.
+
+    This walks the whole subtree, so wrappers created by an OMEXML document
+    are handed the document's namespaces rather than calling this themselves.
+    '''
+    uris = []
+    seen = set()
     for child in node.iter():
-        ns = split_qn(child.tag)[0]
+        tag = child.tag
+        if not callable(tag) and tag.startswith("{"):
+            ns = tag[1:tag.index("}")]
+            if ns not in seen:
+                seen.add(ns)
+                uris.append(ns)
+    return namespaces_from_uris(uris)
+
+def namespaces_from_uris(uris):
+    '''Map OME namespace keys ('ome', 'sa', 'spw', ...) to the given URIs'''
+    ns_lib = {'ome': None, 'sa': None, 'spw': None}
+    for ns in uris:
         match = re.match(NS_RE, ns)
         if match:
             ns_key = match.group('ns_key').lower()
             ns_lib[ns_key] = ns
     return ns_lib
 
+def require_numpy():
+    '''Raise ImportError if numpy, needed by the array methods, is missing'''
+    if np is None:
+        raise ImportError("This method requires numpy to be installed")
+
+def zct_from_index(dimension_order, size_z, size_c, size_t, index):
+    '''Convert plane indices to (Z, C, T) arrays for a DimensionOrder
+
+    dimension_order - one of the DO_* constants, e.g. DO_XYCZT, in which
+                      the first of Z, C and T varies fastest
+    index - an array of zero-based plane indices
+    '''
+    require_numpy()
+    if dimension_order not in DIMENSION_ORDERS:
+        raise ValueError("Invalid DimensionOrder '%s'" % dimension_order)
+    sizes = {"Z": size_z, "C": size_c, "T": size_t}
+    index = np.asarray(index)
+    coordinates = {}
+    for dimension in dimension_order[2:]:
+        coordinates[dimension] = index % sizes[dimension]
+        index = index // sizes[dimension]
+    return coordinates["Z"], coordinates["C"], coordinates["T"]
+
+def index_from_zct(dimension_order, size_z, size_c, size_t, z, c, t):
+    '''Convert (Z, C, T) to plane indices for a DimensionOrder
+
+    This is the inverse of zct_from_index. z, c and t are numbers or
+    arrays of zero-based indices.
+    '''
+    require_numpy()
+    if dimension_order not in DIMENSION_ORDERS:
+        raise ValueError("Invalid DimensionOrder '%s'" % dimension_order)
+    sizes = {"Z": size_z, "C": size_c, "T": size_t}
+    coordinates = {"Z": np.asarray(z), "C": np.asarray(c), "T": np.asarray(t)}
+    index = 0
+    for dimension in reversed(dimension_order[2:]):
+        index = index * sizes[dimension] + coordinates[dimension]
+    return index
+
 def get_float_attr(node, attribute):
     '''Cast an element attribute to a float or return None if not present'''
     attr = node.get(attribute)
@@ -271,6 +473,199 @@ def get_int_attr(node, attribute):
     attr = node.get(attribute)
     return None if attr is None else int(attr)
 
+def sub_element(parent, tag):
+    '''Create a new element with the given tag as the last child of parent
+
+    This works with the elements of either XML backend.
+    '''
+    node = parent.makeelement(tag, {})
+    parent.append(node)
+    return node
+
+def make_elements(parent, tag, columns, count):
+    '''Make count new elements for parent with attributes given by column
+
+    columns - a dictionary of attribute name to a list of count strings,
+              where None leaves the attribute out
+
+    The elements are returned, not added to parent. lxml is slow to make
+    namespaced elements one by one, so for lxml they are parsed together
+    from generated XML instead.
+    '''
+    names = list(columns)
+    if lxml_etree is None or not isinstance(parent, lxml_etree._Element):
+        if not names:
+            return [parent.makeelement(tag, {}) for _ in range(count)]
+        return [parent.makeelement(tag, dict(
+                    item for item in zip(names, row) if item[1] is not None))
+                for row in zip(*[columns[name] for name in names])]
+    namespace, tag_name = tag[1:].split("}")
+    attributes = [[
+        "" if value is None else
+        ' %s="%s"' % (name, value) if RE_ATTR_SAFE.match(value) else
+        " %s=%s" % (name, quoteattr(value)) for value in columns[name]]
+        for name in names]
+    rows = zip(*attributes) if names else [()] * count
+    elements = "".join(["<%s%s/>" % (tag_name, "".join(row)) for row in rows])
+    wrapper = lxml_etree.fromstring(
+        "<wrapper xmlns=%s>%s</wrapper>" % (quoteattr(namespace), elements),
+        lxml_etree.XMLParser(huge_tree=True))
+    return list(wrapper)
+
+def resize_children(parent, tag, count, make_new=None, before=()):
+    '''Add or remove children with the given tag so there are count of them
+
+    parent - the parent element
+    tag - the qualified tag name of the children
+    count - the number of children wanted
+    make_new - a function of n returning n new elements. By default the
+               new elements have no attributes.
+    before - qualified tag names that the children go before if there are
+             none of them yet, to keep the schema's child order
+
+    Surplus children are removed from the end with one slice deletion when
+    they are contiguous and new children are inserted with one slice
+    assignment after the last existing one, so apart from a single walk
+    over the children this is proportional to the size change.
+    '''
+    positions = []
+    insert_at = None
+    for i, child in enumerate(parent):
+        if child.tag == tag:
+            positions.append(i)
+        elif insert_at is None and child.tag in before:
+            insert_at = i
+    if count < len(positions):
+        surplus = positions[count:]
+        if surplus[-1] - surplus[0] == len(surplus) - 1:
+            del parent[surplus[0]:surplus[-1] + 1]
+        else:
+            children = list(parent)
+            for i in surplus:
+                parent.remove(children[i])
+    elif count > len(positions):
+        if make_new is None:
+            new = make_elements(parent, tag, {}, count - len(positions))
+        else:
+            new = make_new(count - len(positions))
+        if positions:
+            insert_at = positions[-1] + 1
+        elif insert_at is None:
+            insert_at = len(parent)
+        parent[insert_at:insert_at] = new
+
+def set_children_attributes(parent, tag, columns, before=()):
+    '''Set the attributes of all children with a tag from columns of values
+
+    parent - the parent element
+    tag - the qualified tag name of the children
+    columns - a dictionary of attribute name to a sequence or array with
+              one value per child or a single value for every child. None
+              and NaN values, single or in sequences, remove the attribute.
+    before - as for resize_children
+
+    The number of children is set to the length of the sequences. Existing
+    children are overwritten and new ones are made with all their
+    attributes at once. Returns the number of children.
+    '''
+    texts = {}
+    lengths = set()
+    for name, values in columns.items():
+        if hasattr(values, "tolist"):
+            values = values.tolist()
+        if isinstance(values, (list, tuple)):
+            texts[name] = [None if value is None or value != value
+                           else str(value) for value in values]
+            lengths.add(len(values))
+        else:
+            texts[name] = None if values is None or values != values else str(values)
+    if len(lengths) > 1:
+        raise ValueError("The %s attributes must all have the same length" %
+                         tag.split("}")[-1])
+    children = parent.findall(tag)
+    count = lengths.pop() if lengths else len(children)
+    del children[count:]
+    for name, values in texts.items():
+        if not isinstance(values, list):
+            texts[name] = values = [values] * count
+        for child, value in zip(children, values):
+            if value is not None:
+                child.set(name, value)
+            elif name in child.attrib:
+                del child.attrib[name]
+    # new children get all their attributes as they are made
+    resize_children(parent, tag, count, lambda n: make_elements(
+        parent, tag, dict((name, values[len(children):])
+                          for name, values in texts.items()), n), before)
+    return count
+
+def get_children_attributes(children, columns):
+    '''Read an attribute of every element into a numpy array per column
+
+    children - a list of elements
+    columns - a sequence of (attribute name, numpy type, text used where the
+              attribute is missing)
+
+    Integers are parsed from the joined text in one numpy call, which is
+    faster than np.array for them but not for floats. Values that can't be
+    parsed raise ValueError, as np.array does.
+    '''
+    require_numpy()
+    if not children:
+        return [np.array([], dtype=dtype) for name, dtype, missing in columns]
+    get = type(children[0]).get
+    arrays = []
+    for name, dtype, missing in columns:
+        values = list(map(get, children, itertools.repeat(name),
+                          itertools.repeat(missing)))
+        array = None
+        if np.dtype(dtype).kind in "iu":
+            try:
+                array = np.fromstring(" ".join(values), dtype=dtype, sep=" ")
+            except (ValueError, DeprecationWarning):
+                # older numpy versions warn and stop early
+                pass
+        if array is None or len(array) != len(values):
+            array = np.array(values, dtype=dtype)
+        arrays.append(array)
+    return arrays
+
+def replace_children(parent, tag, new, before=()):
+    '''Replace all children with the given tag by a list of new elements
+
+    parent - the parent element
+    tag - the qualified tag name of the children to replace
+    new - the elements to put in their place, which may include some of
+          the old children
+    before - qualified tag names that the new elements go before if there
+             are no children with the tag, to keep the schema's child order
+
+    The new elements go where the first old child was. Contiguous old
+    children are replaced with one slice assignment.
+    '''
+    positions = []
+    insert_at = None
+    for i, child in enumerate(parent):
+        if child.tag == tag:
+            positions.append(i)
+        elif insert_at is None and child.tag in before:
+            insert_at = i
+    new = list(new)
+    if positions and positions[-1] - positions[0] == len(positions) - 1:
+        parent[positions[0]:positions[-1] + 1] = new
+        return
+    if positions:
+        children = list(parent)
+        for i in positions:
+            parent.remove(children[i])
+        insert_at = positions[0]
+    elif insert_at is None:
+        insert_at = len(parent)
+    parent[insert_at:insert_at] = new
+
+# Attribute values that can be written into XML without escaping
+RE_ATTR_SAFE = re.compile(r'[^&<>"\n\r\t]*\Z')
+
 def make_text_node(parent, namespace, tag_name, text):
     '''Either make a new node and add the given text or replace the text
 
@@ -282,9 +677,340 @@ def make_text_node(parent, namespace, tag_name, text):
     qname = qn(namespace, tag_name)
     node = parent.find(qname)
     if node is None:
-        node = ElementTree.SubElement(parent, qname)
+        node = sub_element(parent, qname)
     set_text(node, text)
 
+#
+# Patterns for the byte-level scan used by OMEXML(..., lazy=True). Comments,
+# CDATA and processing instructions are matched first so that tags inside
+# them are skipped; the interesting alternative is always group 1.
+#
+RE_SKIP = br"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>"
+RE_ROOT_START = re.compile(RE_SKIP + br"|<((?:[\w.-]+:)?)OME(?=[\s/>])", re.S)
+RE_TAG_END = re.compile(br"(?:[^>\"']|\"[^\"]*\"|'[^']*')*>")
+RE_DEFERRED_START = re.compile(
+    RE_SKIP + br"|<(?:[\w.-]+:)?(StructuredAnnotations|ROI)(?=[\s/>])", re.S)
+RE_SA_START = re.compile(
+    RE_SKIP + br"|<(?:[\w.-]+:)?(StructuredAnnotations)(?=[\s/>])", re.S)
+RE_SA_END = re.compile(
+    RE_SKIP + br"|(</(?:[\w.-]+:)?StructuredAnnotations\s*>)", re.S)
+RE_ROI_START = re.compile(RE_SKIP + br"|<(?:[\w.-]+:)?(ROI)(?=[\s/>])", re.S)
+RE_PIXELS_START = re.compile(
+    RE_SKIP + br"|<((?:[\w.-]+:)?)(?=Pixels[\s/>])", re.S)
+RE_MARKUP_ESCAPES = re.compile(br"<[!?]")
+RE_ENCODING = re.compile(br"\s*<\?xml[^>]*encoding\s*=\s*[\"']([\w.-]+)")
+
+def _search_markup(pattern, view, pos=0):
+    '''Find the next match of pattern's group 1 outside comments and CDATA'''
+    match = pattern.search(view, pos)
+    while match is not None and match.group(1) is None:
+        match = pattern.search(view, match.end())
+    return match
+
+def scan_deferred_sections(xml):
+    '''Locate the StructuredAnnotations and ROI sections of an OME document
+
+    xml - the document as bytes or another buffer
+
+    Returns None if there is nothing to defer or the document can't be
+    scanned safely (e.g. it is not UTF-8). Otherwise returns a tuple of
+
+    head - the bytes of the OME start tag, which carry the namespaces
+    tail - the bytes of the matching end tag
+    skeleton - the (start, stop) byte ranges of everything else
+    deferred - a dictionary of "sa" and/or "roi" to (start, stop) ranges
+    '''
+    encoding = RE_ENCODING.match(xml)
+    if encoding is not None and encoding.group(1).lower() not in (
+            b"utf-8", b"utf8", b"us-ascii", b"ascii"):
+        return None
+    root = _search_markup(RE_ROOT_START, xml)
+    if root is None:
+        return None
+    prefix = root.group(1)
+    head_end = RE_TAG_END.match(xml, root.end())
+    if head_end is None or xml[head_end.end() - 2:head_end.end() - 1] == b"/":
+        return None
+    first = _search_markup(RE_DEFERRED_START, xml, head_end.end())
+    if first is None:
+        return None
+    root_end = _search_markup(
+        re.compile(RE_SKIP + br"|(</" + re.escape(prefix) + br"OME\s*>)", re.S),
+        xml, first.start())
+    if root_end is None:
+        return None
+    deferred = {}
+    roi = first
+    if first.group(1) == b"StructuredAnnotations":
+        sa_end = _search_markup(RE_SA_END, xml, first.end())
+        if sa_end is None:
+            return None
+        roi = _search_markup(RE_ROI_START, xml, sa_end.end())
+        if roi is not None and roi.start() > root_end.start():
+            roi = None
+        sa_stop = root_end.start() if roi is None else roi.start()
+        deferred["sa"] = (first.start(), sa_stop)
+    if roi is not None:
+        deferred["roi"] = (roi.start(), root_end.start())
+        if first is roi and _search_markup(RE_SA_START, xml, roi.end()) is not None:
+            # out of schema order: load both from the one section
+            deferred["sa"] = deferred["roi"]
+    head = bytes(xml[root.start():head_end.end()])
+    tail = bytes(xml[root_end.start():root_end.end()])
+    skeleton = [(0, first.start()), (root_end.start(), len(xml))]
+    return head, tail, skeleton, deferred
+
+#
+# TIFF header layout used to find the ImageDescription of the first IFD
+#
+TIFF_TAG_IMAGE_DESCRIPTION = 270
+TIFF_TYPE_ASCII = 2
+
+def read_tiff_description(source):
+    '''Return the ImageDescription bytes of the first IFD of a TIFF or BigTIFF
+
+    source - the path to a TIFF file or a seekable binary file object
+
+    Only the header, the first IFD and the description itself are read, so
+    the pixel data is never touched. Trailing NUL bytes are stripped.
+    Raises ValueError if the file is not a TIFF or has no description.
+    '''
+    if not hasattr(source, "read"):
+        with open(source, "rb") as fd:
+            return read_tiff_description(fd)
+    fd = source
+    header = fd.read(16)
+    byte_order = {b"II": "<", b"MM": ">"}.get(header[:2])
+    if byte_order is None or len(header) < 8:
+        raise ValueError("Not a TIFF file")
+    magic = struct.unpack(byte_order + "H", header[2:4])[0]
+    if magic == 42:
+        ifd_offset = struct.unpack(byte_order + "I", header[4:8])[0]
+        count_fmt, entry_fmt, inline_size = "H", "HHII", 4
+    elif magic == 43 and len(header) == 16:
+        ifd_offset = struct.unpack(byte_order + "Q", header[8:16])[0]
+        count_fmt, entry_fmt, inline_size = "Q", "HHQQ", 8
+    else:
+        raise ValueError("Not a TIFF file")
+    count_size = struct.calcsize(byte_order + count_fmt)
+    entry_size = struct.calcsize(byte_order + entry_fmt)
+    fd.seek(ifd_offset)
+    entry_count = struct.unpack(byte_order + count_fmt, fd.read(count_size))[0]
+    entries = fd.read(entry_count * entry_size)
+    for offset in range(0, len(entries) - entry_size + 1, entry_size):
+        tag, dtype, count, value = struct.unpack(
+            byte_order + entry_fmt, entries[offset:offset + entry_size])
+        if tag != TIFF_TAG_IMAGE_DESCRIPTION:
+            continue
+        if dtype != TIFF_TYPE_ASCII:
+            raise ValueError("TIFF ImageDescription is not ASCII")
+        if count <= inline_size:
+            data = entries[offset + entry_size - inline_size:][:count]
+        else:
+            fd.seek(value)
+            data = fd.read(count)
+        return data.rstrip(b"\0")
+    raise ValueError("TIFF file has no ImageDescription in its first IFD")
+
+# Size of the blocks read from a file by probe
+PROBE_CHUNK_SIZE = 1 << 16
+
+class ProbeDone(Exception):
+    '''Raised by PixelsProbe to stop the parser once all Pixels are seen'''
+
+class PixelsProbe(object):
+    '''XMLParser target collecting the attributes of each OME/Image/Pixels
+
+    No elements are built. Images are contiguous in the OME schema, so the
+    first top-level element after them ends the probe.
+    '''
+    def __init__(self):
+        self.pixels = []
+        self.depth = 0
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        name = tag.rpartition("}")[2]
+        if self.depth == 2 and self.pixels and name != "Image":
+            raise ProbeDone()
+        if self.depth == 3 and name == "Pixels":
+            self.pixels.append({
+                "ID": attrib.get("ID"),
+                "DimensionOrder": attrib.get("DimensionOrder"),
+                "PixelType": attrib.get("Type"),
+                "SizeX": get_int_attr(attrib, "SizeX"),
+                "SizeY": get_int_attr(attrib, "SizeY"),
+                "SizeZ": get_int_attr(attrib, "SizeZ"),
+                "SizeC": get_int_attr(attrib, "SizeC"),
+                "SizeT": get_int_attr(attrib, "SizeT"),
+                "PhysicalSizeX": get_float_attr(attrib, "PhysicalSizeX"),
+                "PhysicalSizeY": get_float_attr(attrib, "PhysicalSizeY"),
+                "PhysicalSizeZ": get_float_attr(attrib, "PhysicalSizeZ"),
+                "PhysicalSizeXUnit": attrib.get("PhysicalSizeXUnit"),
+                "PhysicalSizeYUnit": attrib.get("PhysicalSizeYUnit"),
+                "PhysicalSizeZUnit": attrib.get("PhysicalSizeZUnit")})
+
+    def end(self, tag):
+        self.depth -= 1
+
+    def close(self):
+        return self.pixels
+
+def probe(source, backend=None):
+    '''Read the dimensions and pixel type of every image without parsing it all
+
+    source - a file path (str or os.PathLike), a binary file object,
+             OME-XML text or a buffer (bytes, memoryview, mmap...)
+
+    Returns a list with a dictionary per image holding the Pixels ID,
+    DimensionOrder, PixelType, SizeX/Y/Z/C/T and PhysicalSizeX/Y/Z with
+    their units, as the matching Pixels properties would return them.
+    The document is parsed as events with no tree and parsing stops at
+    the first element following the images. The children of each Pixels
+    element (Channels, TiffData and Planes) are skipped over as bytes
+    without being parsed, for buffers and files that can be memory-mapped.
+
+    backend - the XML backend to parse with, see get_backend
+
+    >>> [(p["SizeZ"], p["SizeT"]) for p in probe("tomo_0001.companion.ome")]
+    '''
+    if isinstance(source, os.PathLike):
+        source = os.fspath(source)
+    if hasattr(source, "encode") and not isinstance(source, bytes):
+        if not source.lstrip().startswith("<"):
+            with open(source, "rb") as fd:
+                return probe(fd, backend)
+        source = source.encode("utf-8")
+    # mmap objects have a read method too but are used as buffers
+    is_file = hasattr(source, "read") and not isinstance(source, mmap.mmap)
+    if is_file:
+        try:
+            mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # e.g. an in-memory file, a pipe or an empty file
+            pass
+        else:
+            with mapped:
+                return probe(mapped, backend)
+    target = PixelsProbe()
+    parser = make_parser(backend, target)
+    feed = parser.feed
+    if (backend or DEFAULT_BACKEND) == BACKEND_LXML:
+        feed = lambda chunk: parser.feed(bytes(chunk))
+    try:
+        if is_file:
+            chunk = source.read(PROBE_CHUNK_SIZE)
+            while chunk:
+                feed(chunk)
+                chunk = source.read(PROBE_CHUNK_SIZE)
+        else:
+            with memoryview(source) as view:
+                if view.ndim != 1 or view.itemsize != 1:
+                    view = view.cast("B")
+                for start, stop in probe_ranges(view):
+                    for offset in range(start, stop, PROBE_CHUNK_SIZE):
+                        feed(view[offset:min(offset + PROBE_CHUNK_SIZE, stop)])
+        return parser.close()
+    except ProbeDone:
+        return target.pixels
+
+def probe_ranges(xml):
+    '''The byte ranges of a document that probe has to parse
+
+    xml - the document as bytes or another buffer
+
+    The ranges leave out the content of each Pixels element, so that the
+    parser sees <Pixels ...></Pixels>. The whole document is one range if
+    it can't be scanned safely (e.g. it is not UTF-8).
+    '''
+    encoding = RE_ENCODING.match(xml)
+    if encoding is not None and encoding.group(1).lower() not in (
+            b"utf-8", b"utf8", b"us-ascii", b"ascii"):
+        yield 0, len(xml)
+        return
+    position = 0
+    while True:
+        start = _search_markup(RE_PIXELS_START, xml, position)
+        if start is None:
+            break
+        start_end = RE_TAG_END.match(xml, start.end())
+        if start_end is None:
+            break
+        if xml[start_end.end() - 2:start_end.end() - 1] == b"/":
+            # <Pixels .../> has nothing to skip
+            yield position, start_end.end()
+            position = start_end.end()
+            continue
+        # the end tag is found as a plain string, which is quick, unless a
+        # comment, CDATA or processing instruction could be hiding one
+        end_tag = br"</" + re.escape(start.group(1)) + br"Pixels\s*>"
+        end = re.compile(end_tag).search(xml, start_end.end())
+        if end is None:
+            break
+        if RE_MARKUP_ESCAPES.search(xml, start_end.end(), end.start()) is not None:
+            end = _search_markup(
+                re.compile(RE_SKIP + br"|(" + end_tag + br")", re.S), xml, start_end.end())
+            if end is None:
+                break
+        yield position, start_end.end()
+        position = end.start()
+    yield position, len(xml)
+
+ParseResult = collections.namedtuple(
+    "ParseResult", ["index", "source", "omexml", "error", "value"])
+ParseResult.__doc__ = '''The outcome of parsing one source in OMEXML.parse_many
+
+index - the position of the source in the input
+source - the path or buffer that was parsed
+omexml - the OMEXML document or None if parsing failed or func was given
+error - the exception raised while parsing or None
+value - what func returned for the document, if func was given
+'''
+
+def parse_source(source, backend=None):
+    '''Parse a path, OME-XML text or a buffer into an OMEXML document'''
+    if isinstance(source, os.PathLike):
+        source = os.fspath(source)
+    if hasattr(source, "encode") and not isinstance(source, bytes):
+        if not source.lstrip().startswith("<"):
+            return OMEXML.from_file(source, backend=backend)
+    return OMEXML(source, backend=backend)
+
+def sendable_source(source):
+    '''A source for parse_source that can be pickled to a worker process
+
+    Paths become str and buffers other than bytes (memoryview, mmap...)
+    are copied to bytes.
+    '''
+    if isinstance(source, os.PathLike):
+        return os.fspath(source)
+    if isinstance(source, bytes) or hasattr(source, "encode"):
+        return source
+    return bytes(memoryview(source))
+
+def parse_chunk(items, backend=None, func=None):
+    '''Parse a list of (index, source) in a worker process for OMEXML.parse_many
+
+    Returns (index, omexml, error, value) for each source, where value is
+    func(omexml) and omexml is None if func is given.
+    '''
+    results = []
+    for index, source in items:
+        try:
+            omexml = parse_source(source, backend)
+            if func is None:
+                results.append((index, omexml, None, None))
+            else:
+                results.append((index, None, None, func(omexml)))
+        except Exception as e:
+            try:
+                pickle.dumps(e)
+            except Exception:
+                # e.g. lxml's XMLSyntaxError, which can't be sent back
+                e = Exception("%s: %s" % (type(e).__name__, e))
+            results.append((index, None, e, None))
+    return results
+
 class OMEXML(object):
     '''Reads and writes OME-XML with methods to get and set it.
 
@@ -293,7 +1019,8 @@ class OMEXML(object):
     let the caller create and modify OME-XML.
 
     There are two ways to invoke the constructor. If you supply XML as a string
-    or unicode string, the constructor will parse it and will use it as the
+    or unicode string, or as bytes or any other buffer (bytearray, memoryview,
+    mmap), the constructor will parse it and will use it as the
     base for any inspection and modification. If you don't supply XML, you'll
     get a bland OME-XML object which has a one-channel image. You can modify
     it programatically and get the modified OME-XML back out by calling to_xml.
@@ -328,21 +1055,226 @@ class OMEXML(object):
     See the `OME-XML schema documentation <http://git.openmicroscopy.org/src/develop/components/specification/Documentation/Generated/OME-2011-06/ome.html>`_.
 
     '''
-    def __init__(self, xml=None):
+    def __init__(self, xml=None, lazy=False, backend=None):
+        '''Parse xml or the default document
+
+        xml - the OME-XML as text, bytes or any other buffer
+        lazy - if True, the StructuredAnnotations and ROI sections are located
+               by a fast scan of the bytes but are only parsed the first time
+               structured_annotations(), roi() or roi_count is used. Until
+               then they are missing from root_node. The buffer must stay
+               valid (e.g. an mmap must stay open) until they are loaded.
+        backend - the XML backend, BACKEND_ETREE or BACKEND_LXML. The default,
+                  None, uses lxml if it is installed.
+        '''
+        self.backend = backend or DEFAULT_BACKEND
         if xml is None:
             xml = default_xml
-        if isinstance(xml, str):
+        if not isinstance(xml, bytes) and hasattr(xml, "encode"):
             xml = xml.encode("utf-8")
-        try:
-            self.dom = ElementTree.ElementTree(ElementTree.fromstring(xml))
-        except UnicodeEncodeError:
-            xml = xml.encode("utf-8")
-            self.dom = ElementTree.ElementTree(ElementTree.fromstring(xml))
+        sections = scan_deferred_sections(xml) if lazy else None
+        if sections is None:
+            self._set_root(self._parse_buffer(xml))
+        else:
+            head, tail, skeleton, deferred = sections
+            self._set_root(self._parse_buffer(xml, skeleton))
+            self._deferred = deferred
+            self._deferred_source = (xml, head, tail)
+
+    @classmethod
+    def from_file(cls, source, backend=None):
+        '''Parse OME-XML incrementally from a file path or file object
+
+        The file is read in small blocks by iterparse, so the document text
+        is never held in memory alongside the tree. The namespaces are
+        collected from the parser's namespace events as it goes, which saves
+        a second walk over the finished tree.
+
+        >>> o = OMEXML.from_file("tomo_0001.companion.ome")
+        '''
+        self = cls.__new__(cls)
+        self.backend = backend or DEFAULT_BACKEND
+        options = {}
+        if self.backend == BACKEND_LXML:
+            options = dict(remove_comments=True, remove_pis=True, huge_tree=True)
+        uris = []
+        parser = get_backend(self.backend).iterparse(
+            source, events=("start-ns",), **options)
+        for event, (prefix, uri) in parser:
+            uris.append(uri)
+        self._set_root(parser.root, namespaces_from_uris(uris))
+        return self
+
+    @classmethod
+    def from_tiff(cls, source, backend=None):
+        '''Parse the OME-XML held in the ImageDescription of an OME-TIFF
+
+        source - the path to an OME-TIFF file or a seekable binary file object
+
+        Only the TIFF header and first IFD are read (see read_tiff_description).
+        '''
+        return cls(read_tiff_description(source), backend=backend)
+
+    @staticmethod
+    def parse_many(sources, workers=None, chunksize=1, ordered=True, backend=None,
+                   func=None):
+        '''Parse many documents in parallel using a pool of processes
+
+        sources - an iterable of file paths, OME-XML text or buffers. They are
+                  read from the iterable as the workers need them. Buffers
+                  other than bytes (memoryview, mmap...) are copied to bytes
+                  a chunk at a time so that they can be sent to the workers.
+        workers - the number of worker processes, the number of CPUs if None.
+                  With 0 or 1 the sources are parsed here, one by one.
+        chunksize - the number of sources sent to a worker at a time
+        ordered - if True, results come in the order of sources, otherwise
+                  as soon as each chunk is done
+        backend - the XML backend, see get_backend
+        func - a function of an OMEXML document, run in the worker, whose
+               result is returned as ParseResult.value instead of the
+               document. It and its results must be picklable, so it can't
+               be a lambda.
+
+        This is a generator of ParseResult. A source that fails to parse, or
+        can't be sent to a worker, gives a result holding the exception
+        rather than stopping the batch.
+
+        Documents returned from workers are pickled, which means the tree
+        is built again in this process: unpickling a document takes about
+        as long as parsing it. Returning whole documents only pays off
+        when reading the sources is the slow part. To parallelise the
+        parsing itself, extract what you need in the workers with func:
+
+        >>> def summary(omexml):
+        ...     pixels = omexml.image().Pixels
+        ...     return pixels.SizeZ, pixels.SizeC, pixels.SizeT
+        >>> for result in OMEXML.parse_many(paths, workers=32, chunksize=16,
+        ...                                 func=summary):
+        ...     if result.error is None:
+        ...         catalogue(result.source, result.value)
+        '''
+        chunksize = max(1, chunksize)
+        if workers is None:
+            workers = os.cpu_count()
+        if workers <= 1:
+            for index, source in enumerate(sources):
+                for _, omexml, error, value in parse_chunk(
+                        [(index, source)], backend, func):
+                    yield ParseResult(index, source, omexml, error, value)
+            return
+        sources = enumerate(sources)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            # chunks in flight, each with its sources and the results of
+            # any that couldn't be sent
+            pending = collections.OrderedDict()
+            exhausted = False
+            while pending or not exhausted:
+                while not exhausted and len(pending) < 2 * workers:
+                    chunk = list(itertools.islice(sources, chunksize))
+                    if not chunk:
+                        exhausted = True
+                        break
+                    items = []
+                    failed = []
+                    for index, source in chunk:
+                        try:
+                            items.append((index, sendable_source(source)))
+                        except Exception as e:
+                            failed.append((index, None, e, None))
+                    future = pool.submit(parse_chunk, items, backend, func)
+                    pending[future] = (dict(chunk), items, failed)
+                if not pending:
+                    break
+                if ordered:
+                    future = next(iter(pending))
+                else:
+                    future = next(iter(concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED).done))
+                originals, items, failed = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    # the chunk as a whole failed, e.g. its results couldn't be pickled
+                    results = [(index, None, e, None) for index, source in items]
+                for index, omexml, error, value in sorted(failed + results,
+                                                          key=lambda result: result[0]):
+                    yield ParseResult(index, originals[index], omexml, error, value)
+
+    def _parse_buffer(self, xml, ranges=None, head=None, tail=None):
+        '''Parse XML from bytes or any object supporting the buffer protocol
+
+        The buffer (bytes, bytearray, memoryview, mmap...) is fed to the
+        parser through memoryview slices of PARSE_CHUNK_SIZE bytes, so no
+        intermediate copy of the whole document is made.
+
+        ranges - the (start, stop) byte ranges to parse or None for all
+        head, tail - bytes to feed before and after the ranges
+        '''
+        with memoryview(xml) as view:
+            if view.ndim != 1 or view.itemsize != 1:
+                view = view.cast("B")
+            parser = make_parser(self.backend)
+            if head:
+                parser.feed(head)
+            for start, stop in ranges or [(0, len(view))]:
+                for offset in range(start, stop, PARSE_CHUNK_SIZE):
+                    chunk = view[offset:min(offset + PARSE_CHUNK_SIZE, stop)]
+                    if self.backend == BACKEND_LXML:
+                        # lxml only accepts bytes, so copy one chunk at a time
+                        chunk = chunk.tobytes()
+                    parser.feed(chunk)
+            if tail:
+                parser.feed(tail)
+            return parser.close()
+
+    def _set_root(self, root, ns=None):
+        '''Use root as the document's root element
+
+        root - the parsed OME element
+        ns - the OME namespaces of the document or None to look them up
+        '''
+        self.dom = get_backend(self.backend).ElementTree(root)
+        self._deferred = {}
+        self._deferred_source = None
         # determine OME namespaces
-        self.ns = get_namespaces(self.dom.getroot())
+        self.ns = get_namespaces(root) if ns is None else ns
         if self.ns['ome'] is None:
             raise Exception("Error: String not in OME-XML format")
 
+    def _load_deferred(self, key=None):
+        '''Parse sections skipped by a lazy constructor into the tree
+
+        key - "sa" for StructuredAnnotations, "roi" for the ROIs or None
+              for everything still deferred
+        '''
+        keys = list(self._deferred) if key is None else [key]
+        for key in keys:
+            section = self._deferred.pop(key, None)
+            if section is None:
+                continue
+            for other in [k for k, v in self._deferred.items() if v == section]:
+                del self._deferred[other]
+            xml, head, tail = self._deferred_source
+            fragment = self._parse_buffer(xml, [section], head, tail)
+            root = self.root_node
+            position = len(root)
+            if key == "sa":
+                # StructuredAnnotations precede the ROIs in the schema
+                roi_tag = qn(self.ns['ome'], "ROI")
+                for index, child in enumerate(root):
+                    if child.tag == roi_tag:
+                        position = index
+                        break
+            # lxml moves the children, leaving fragment empty, so look
+            # at their namespaces first
+            namespaces = get_namespaces(fragment)
+            root[position:position] = list(fragment)
+            for ns_key, ns in namespaces.items():
+                if ns is not None:
+                    self.ns[ns_key] = ns
+        if not self._deferred:
+            self._deferred_source = None
+
     @staticmethod
     def _indent(elem, width=4, level=0):
         """
@@ -370,6 +1302,7 @@ class OMEXML(object):
                 elem.tail = i
 
     def __str__(self):
+        self._load_deferred()
         # need to register the ome namespace because BioFormats expects
         # that namespace to be the default or to be explicitly named "ome"
         for ns_key in ["ome", "sa", "spw"]:
@@ -378,14 +1311,57 @@ class OMEXML(object):
         ElementTree.register_namespace("om", NS_ORIGINAL_METADATA)
         result = StringIO()
         OMEXML._indent(self.root_node)
-        ElementTree.ElementTree(self.root_node).write(result,
-                                                      encoding=uenc,
-                                                      method="xml")
+        root = self.root_node
+        if self.backend == BACKEND_LXML:
+            xml = lxml_to_string(root, self.ns['ome'])
+            if xml is not None:
+                return xml
+            # otherwise ElementTree writes it, so that the output is the
+            # same whichever backend holds the document
+            root = ElementTree.fromstring(lxml_etree.tostring(root))
+            # the parsed copy loses the tail _indent gives the root element
+            root.tail = "\n" if len(root) else None
+        ElementTree.ElementTree(root).write(result,
+                                            encoding=uenc,
+                                            method="xml")
         return result.getvalue()
 
     def to_xml(self, indent="\t", newline="\n", encoding=uenc):
         return str(self)
 
+    def __getstate__(self):
+        '''Pickle the document as compact XML bytes and its namespaces
+
+        Unpickling parses the bytes but skips the namespace scan, and
+        unlike str() nothing is indented, so this is cheaper than passing
+        str(omexml) and parsing it again. For a 50000 plane document a
+        pickle round trip takes about three quarters of the time of str()
+        and OMEXML() with ElementTree and a sixth of it with lxml. Any
+        lazily deferred sections are loaded first.
+        '''
+        self._load_deferred()
+        etree = get_backend(self.backend)
+        return {"backend": self.backend,
+                "ns": self.ns,
+                "xml": etree.tostring(self.root_node)}
+
+    def __setstate__(self, state):
+        backend = state["backend"]
+        if backend == BACKEND_LXML and lxml_etree is None:
+            backend = BACKEND_ETREE
+        self.backend = backend
+        self._set_root(self._parse_buffer(state["xml"]), dict(state["ns"]))
+
+    def copy(self):
+        '''Return a deep copy of the document that can be modified independently'''
+        other = self.__class__.__new__(self.__class__)
+        other.backend = self.backend
+        other.dom = get_backend(self.backend).ElementTree(copy.deepcopy(self.root_node))
+        other.ns = dict(self.ns)
+        other._deferred = dict(self._deferred)
+        other._deferred_source = self._deferred_source
+        return other
+
     def get_ns(self, key):
         return self.ns[key]
 
@@ -398,21 +1374,23 @@ class OMEXML(object):
         return len(self.root_node.findall(qn(self.ns['ome'], "Image")))
 
     def set_image_count(self, value):
-        '''Add or remove image nodes as needed'''
+        '''Add or remove image nodes as needed
+
+        New images are copies of one prototype Image, Pixels and Channel
+        with the IDs changed, inserted after the last image. Surplus images
+        are removed from the end.
+        '''
         assert value > 0
         root = self.root_node
-        if self.image_count > value:
-            image_nodes = root.find(qn(self.ns['ome'], "Image"))
-            for image_node in image_nodes[value:]:
-                root.remove(image_node)
-        while(self.image_count < value):
-            new_image = self.Image(ElementTree.SubElement(root, qn(self.ns['ome'], "Image")))
-            new_image.ID = str(uuid.uuid4())
+
+        def make_images(n):
+            new_image = self.Image(root.makeelement(qn(self.ns['ome'], "Image"), {}), self.ns)
+            new_image.ID = ""
             new_image.Name = "default.png"
             new_image.AcquisitionDate = xsd_now()
             new_pixels = self.Pixels(
-                ElementTree.SubElement(new_image.node, qn(self.ns['ome'], "Pixels")))
-            new_pixels.ID = str(uuid.uuid4())
+                sub_element(new_image.node, qn(self.ns['ome'], "Pixels")), self.ns)
+            new_pixels.ID = ""
             new_pixels.DimensionOrder = DO_XYCTZ
             new_pixels.PixelType = PT_UINT8
             new_pixels.SizeC = 1
@@ -421,16 +1399,33 @@ class OMEXML(object):
             new_pixels.SizeY = 512
             new_pixels.SizeZ = 1
             new_channel = self.Channel(
-                ElementTree.SubElement(new_pixels.node, qn(self.ns['ome'], "Channel")))
-            new_channel.ID = "Channel%d:0" % self.image_count
-            new_channel.Name = new_channel.ID
+                sub_element(new_pixels.node, qn(self.ns['ome'], "Channel")), self.ns)
+            new_channel.ID = new_channel.Name = ""
             new_channel.SamplesPerPixel = 1
+            prototype = new_image.node
+            first = value - n
+            images = []
+            for index in range(first, value):
+                image = copy.deepcopy(prototype)
+                pixels = image[-1]
+                channel = pixels[0]
+                image.set("ID", str(uuid.uuid4()))
+                pixels.set("ID", str(uuid.uuid4()))
+                # numbered by the image count once the image is added
+                channel.set("ID", "Channel%d:0" % (index + 1))
+                channel.set("Name", channel.get("ID"))
+                images.append(image)
+            return images
+
+        resize_children(root, qn(self.ns['ome'], "Image"), value, make_images,
+                        before=[qn(self.ns['ome'], name) for name in
+                                ("StructuredAnnotations", "ROI", "BinaryOnly")])
 
     image_count = property(get_image_count, set_image_count)
 
     @property
     def plates(self):
-        return self.PlatesDucktype(self.root_node)
+        return self.PlatesDucktype(self.root_node, self.ns)
 
     def structured_annotations(self):
         '''Return the structured annotations container
@@ -438,18 +1433,19 @@ class OMEXML(object):
         returns a wrapping of OME/StructuredAnnotations. It creates
         the element if it doesn't exist.
         '''
+        self._load_deferred("sa")
         node = self.root_node.find(qn(self.ns['sa'], "StructuredAnnotations"))
         if node is None:
-            node = ElementTree.SubElement(
+            node = sub_element(
                 self.root_node, qn(self.ns['sa'], "StructuredAnnotations"))
-        return self.StructuredAnnotations(node)
+        return self.StructuredAnnotations(node, self.ns)
 
     class Image(object):
         '''Representation of the OME/Image element'''
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             '''Initialize with the DOM Image node'''
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_ID(self):
             return self.node.get("ID")
@@ -475,7 +1471,7 @@ class OMEXML(object):
         def set_AcquisitionDate(self, date):
             acquired_date = self.node.find(qn(self.ns["ome"], "AcquisitionDate"))
             if acquired_date is None:
-                acquired_date = ElementTree.SubElement(
+                acquired_date = sub_element(
                     self.node, qn(self.ns["ome"], "AcquisitionDate"))
             set_text(acquired_date, date)
         AcquisitionDate = property(get_AcquisitionDate, set_AcquisitionDate)
@@ -494,11 +1490,11 @@ class OMEXML(object):
             >>> timepoint_count = pixels.SizeT
 
             '''
-            return OMEXML.Pixels(self.node.find(qn(self.ns['ome'], "Pixels")))
+            return OMEXML.Pixels(self.node.find(qn(self.ns['ome'], "Pixels")), self.ns)
 
         def roiref(self, index=0):
             '''The OME/Image/ROIRef element'''
-            return OMEXML.ROIRef(self.node.findall(qn(self.ns['ome'], "ROIRef"))[index])
+            return OMEXML.ROIRef(self.node.findall(qn(self.ns['ome'], "ROIRef"))[index], self.ns)
 
         def get_roiref_count(self):
             return len(self.node.findall(qn(self.ns['ome'], "ROIRef")))
@@ -511,20 +1507,124 @@ class OMEXML(object):
                     self.node.remove(roiref_node)
             while(self.roiref_count < value):
                 iteration = self.roiref_count - 1
-                new_roiref = OMEXML.ROIRef(ElementTree.SubElement(self.node, qn(self.ns['ome'], "ROIRef")))
+                new_roiref = OMEXML.ROIRef(sub_element(self.node, qn(self.ns['ome'], "ROIRef")), self.ns)
                 new_roiref.set_ID("ROI:" + str(iteration))
 
         roiref_count = property(get_roiref_count, set_roiref_count)
 
     def image(self, index=0):
         '''Return an image node by index'''
-        return self.Image(self.root_node.findall(qn(self.ns['ome'], "Image"))[index])
+        return self.Image(self.root_node.findall(qn(self.ns['ome'], "Image"))[index], self.ns)
+
+    def check_consistency(self):
+        '''Check the planes and TiffData of every image against its sizes
+
+        Returns a list with a dictionary for each image:
+
+        Image - the index of the image
+        ID - the ID of the image
+        PlanesOutOfRange - the indices of planes whose TheZ, TheC or TheT
+                           is missing or not within SizeZ, SizeC or SizeT
+        DuplicatePlanes - an (N, 3) array of the (Z, C, T) of planes that
+                          appear more than once
+        MissingPlanes - the number of (Z, C, T) without a plane, if there
+                        are planes
+        TiffDataOutOfRange - the indices of TiffData that start outside
+                             the image, run past its end or have no planes
+        UncoveredPlanes - the number of (Z, C, T) without a TiffData, if
+                          there are TiffData
+        OverlappingPlanes - the number of (Z, C, T) in more than one
+                            TiffData
+        Problems - a description of each problem found, empty if none
+
+        The checks are done with numpy over all planes and TiffData at
+        once. Reading the attributes from the tree is most of the cost: for
+        an image with 100,000 planes and one TiffData this takes about
+        50 ms with ElementTree and 130 ms with lxml, and 115 ms and 310 ms
+        with a TiffData per plane.
+
+        >>> for report in o.check_consistency():
+        ...     if report["Problems"]:
+        ...         raise ValueError("; ".join(report["Problems"]))
+        '''
+        require_numpy()
+        reports = []
+        for image_index, image in enumerate(
+                self.root_node.iterfind(qn(self.ns['ome'], "Image"))):
+            image = OMEXML.Image(image, self.ns)
+            pixels = image.Pixels
+            sizes = (pixels.SizeZ, pixels.SizeC, pixels.SizeT)
+            total = sizes[0] * sizes[1] * sizes[2]
+            problems = []
+            # planes
+            table = pixels.plane_table(("TheZ", "TheC", "TheT"))
+            z, c, t = table["TheZ"], table["TheC"], table["TheT"]
+            in_range = (z >= 0) & (z < sizes[0]) & (c >= 0) & (c < sizes[1]) & \
+                       (t >= 0) & (t < sizes[2])
+            out_of_range = np.flatnonzero(~in_range)
+            counts = np.bincount(
+                ((z * sizes[1] + c) * sizes[2] + t)[in_range], minlength=total)
+            duplicates = np.stack(np.unravel_index(
+                np.flatnonzero(counts > 1), sizes), axis=1)
+            missing = int(np.count_nonzero(counts == 0)) if len(table) else 0
+            if len(out_of_range):
+                problems.append("%d planes have TheZ, TheC or TheT out of range" %
+                                len(out_of_range))
+            if len(duplicates):
+                problems.append("%d (Z, C, T) have more than one plane" %
+                                len(duplicates))
+            if missing:
+                problems.append("%d of %d (Z, C, T) have no plane" % (missing, total))
+            # TiffData
+            nodes, start, ifd, count = pixels._tiffdata_runs(clip=False)
+            tiffdata_out_of_range = np.flatnonzero(
+                (start < 0) | (count < 1) | (start + count > total))
+            count = np.where(start < 0, 0, np.clip(
+                np.minimum(count, total - start), 0, None))
+            # the offset of each covered plane within its run
+            offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+            covered = np.bincount(np.repeat(start, count) + offset, minlength=total)
+            uncovered = int(np.count_nonzero(covered == 0)) if len(nodes) else 0
+            overlapping = int(np.count_nonzero(covered > 1))
+            if len(tiffdata_out_of_range):
+                problems.append(
+                    "%d TiffData start outside the image, run past its end "
+                    "or have no planes" % len(tiffdata_out_of_range))
+            if uncovered:
+                problems.append("%d of %d (Z, C, T) have no TiffData" %
+                                (uncovered, total))
+            if overlapping:
+                problems.append("%d planes are in more than one TiffData" %
+                                overlapping)
+            reports.append({
+                "Image": image_index,
+                "ID": image.ID,
+                "PlanesOutOfRange": out_of_range,
+                "DuplicatePlanes": duplicates,
+                "MissingPlanes": missing,
+                "TiffDataOutOfRange": tiffdata_out_of_range,
+                "UncoveredPlanes": uncovered,
+                "OverlappingPlanes": overlapping,
+                "Problems": problems})
+        return reports
+
+    def tiff_dataset_index(self):
+        '''Find the file and IFD of every plane of every image
+
+        Returns a TiffDatasetIndex built in one pass over the TiffData of
+        all images, for datasets whose planes are spread over several
+        OME-TIFF files:
+
+        >>> index = o.tiff_dataset_index()
+        >>> file_name, file_uuid, ifd = index.lookup(0, z, c, t)
+        '''
+        return TiffDatasetIndex(self)
 
     class Channel(object):
         '''The OME/Image/Pixels/Channel element'''
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_ID(self):
             return self.node.get("ID")
@@ -556,9 +1656,9 @@ class OMEXML(object):
         For our purposes, there will be one TiffData per 2-dimensional image plane.
         """
 
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_FirstZ(self):
             '''The Z index of the plane'''
@@ -605,6 +1705,37 @@ class OMEXML(object):
 
         plane_count = property(get_plane_count, set_plane_count)
 
+        def get_UUID(self):
+            '''The UUID of the file holding the planes, e.g. urn:uuid:...
+
+            None means the planes are in the file with this OME-XML.
+            '''
+            uuid_node = self.node.find(qn(self.ns['ome'], "UUID"))
+            return None if uuid_node is None else get_text(uuid_node)
+
+        def set_UUID(self, value):
+            make_text_node(self.node, self.ns['ome'], "UUID", value)
+
+        UUID = property(get_UUID, set_UUID)
+
+        def get_FileName(self):
+            '''The name of the file holding the planes, given with the UUID
+
+            Setting it without a UUID gives the file a new urn:uuid: one,
+            as the UUID element can't be empty. Set UUID to that of the file.
+            '''
+            uuid_node = self.node.find(qn(self.ns['ome'], "UUID"))
+            return None if uuid_node is None else uuid_node.get("FileName")
+
+        def set_FileName(self, value):
+            uuid_node = self.node.find(qn(self.ns['ome'], "UUID"))
+            if uuid_node is None:
+                uuid_node = sub_element(self.node, qn(self.ns['ome'], "UUID"))
+                set_text(uuid_node, "urn:uuid:%s" % uuid.uuid4())
+            uuid_node.set("FileName", value)
+
+        FileName = property(get_FileName, set_FileName)
+
     class Plane(object):
         '''The OME/Image/Pixels/Plane element
 
@@ -612,9 +1743,9 @@ class OMEXML(object):
         has the Z, C and T indices of the plane and optionally has the
         X, Y, Z, exposure time and a relative time delta.
         '''
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_TheZ(self):
             '''The Z index of the plane'''
@@ -726,9 +1857,11 @@ class OMEXML(object):
         pixel data. It has the X, Y, Z, C, and T extents of the image
         and it specifies the channel interleaving and channel depth.
         '''
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
+            # (number of children when built, {(z, c, t): Plane node})
+            self._plane_index = None
 
         def get_ID(self):
             return self.node.get("ID")
@@ -859,26 +1992,33 @@ class OMEXML(object):
 
         def set_channel_count(self, value):
             assert value > 0
-            channel_count = self.channel_count
-            if channel_count > value:
-                channels = self.node.findall(qn(self.ns['ome'], "Channel"))
-                for channel in channels[value:]:
-                    self.node.remove(channel)
-            else:
-                for _ in range(channel_count, value):
-                    new_channel = OMEXML.Channel(
-                        ElementTree.SubElement(self.node, qn(self.ns['ome'], "Channel")))
-                    new_channel.ID = str(uuid.uuid4())
-                    new_channel.Name = new_channel.ID
-                    new_channel.SamplesPerPixel = 1
+            def make_channels(n):
+                ids = [str(uuid.uuid4()) for _ in range(n)]
+                return make_elements(
+                    self.node, qn(self.ns['ome'], "Channel"),
+                    {"ID": ids, "Name": ids, "SamplesPerPixel": ["1"] * n}, n)
+            resize_children(
+                self.node, qn(self.ns['ome'], "Channel"), value, make_channels,
+                before=[qn(self.ns['ome'], name) for name in
+                        ("BinData", "TiffData", "MetadataOnly", "Plane")])
 
         channel_count = property(get_channel_count, set_channel_count)
 
         def Channel(self, index=0):
             '''Get the indexed channel from the Pixels element'''
             channel = self.node.findall(qn(self.ns['ome'], "Channel"))[index]
-            return OMEXML.Channel(channel)
+            return OMEXML.Channel(channel, self.ns)
         channel = Channel
+
+        def iter_channels(self, start=None, stop=None, step=None):
+            '''Iterate over the channels, optionally over a slice of them
+
+            The children are walked once and only the channels in the slice
+            are wrapped, e.g. pixels.iter_channels(1, 3) for channels 1 and 2.
+            '''
+            for node in itertools.islice(
+                    self.node.iterfind(qn(self.ns['ome'], "Channel")), start, stop, step):
+                yield OMEXML.Channel(node, self.ns)
         
         def get_plane_count(self):
             '''The number of planes in the image
@@ -897,47 +2037,497 @@ class OMEXML(object):
 
         def set_plane_count(self, value):
             assert value >= 0
-            plane_count = self.plane_count
-            if plane_count > value:
-                planes = self.node.findall(qn(self.ns['ome'], "Plane"))
-                for plane in planes[value:]:
-                    self.node.remove(plane)
-            else:
-                for _ in range(plane_count, value):
-                    new_plane = OMEXML.Plane(
-                        ElementTree.SubElement(self.node, qn(self.ns['ome'], "Plane")))
+            self._plane_index = None
+            resize_children(self.node, qn(self.ns['ome'], "Plane"), value)
 
         plane_count = property(get_plane_count, set_plane_count)
 
         def Plane(self, index=0):
             '''Get the indexed plane from the Pixels element'''
             plane = self.node.findall(qn(self.ns['ome'], "Plane"))[index]
-            return OMEXML.Plane(plane)
+            return OMEXML.Plane(plane, self.ns)
         plane = Plane
+
+        def iter_planes(self, start=None, stop=None, step=None):
+            '''Iterate over the planes, optionally over a slice of them
+
+            Unlike calling Plane(i) for each i, which searches all planes
+            every time, this walks the children once and stops at stop:
+
+            >>> for plane in pixels.iter_planes(1000, 2000):
+            ...     print(plane.DeltaT)
+            '''
+            for node in itertools.islice(
+                    self.node.iterfind(qn(self.ns['ome'], "Plane")), start, stop, step):
+                yield OMEXML.Plane(node, self.ns)
+
+        def populate_planes(self, DeltaT=None, ExposureTime=None, **columns):
+            '''Make one Plane per Z, C and T in the order of DimensionOrder
+
+            Any existing planes are removed, then SizeZ * SizeC * SizeT
+            planes are written with set_planes, their TheZ, TheC and TheT
+            computed with numpy from the plane index. DeltaT, ExposureTime
+            and any other set_planes keywords give per-plane values in the
+            same order.
+
+            >>> pixels.DimensionOrder = DO_XYCZT
+            >>> pixels.populate_planes(DeltaT=times, DeltaTUnit="s")
+            '''
+            require_numpy()
+            count = self.SizeZ * self.SizeC * self.SizeT
+            z, c, t = zct_from_index(self.DimensionOrder, self.SizeZ, self.SizeC,
+                                     self.SizeT, np.arange(count))
+            # values of the old planes mustn't carry over to new coordinates
+            self.plane_count = 0
+            if DeltaT is not None:
+                columns["DeltaT"] = DeltaT
+            if ExposureTime is not None:
+                columns["ExposureTime"] = ExposureTime
+            self.set_planes(TheZ=z, TheC=c, TheT=t, **columns)
+
+        def plane_at(self, z, c, t):
+            '''Get the plane with the given TheZ, TheC and TheT or None
+
+            The first call builds a (z, c, t) index of the planes, so later
+            calls on the same Pixels object take constant time, including
+            those for coordinates without a plane; keep the object rather
+            than calling image().Pixels for every lookup. The index is
+            rebuilt when children are appended, removed or replaced, when
+            set_plane_count or set_planes is used, and when a plane found
+            through it has moved or no longer has the requested coordinates.
+            Call invalidate_plane_index after changing TheZ, TheC or TheT of
+            planes or, with lxml, inserting planes before the last child.
+
+            >>> pixels = o.image().Pixels
+            >>> pixels.plane_at(12, 1, 300).DeltaT
+            '''
+            key = (z, c, t)
+            for attempt in range(2):
+                if (self._plane_index is None or
+                        self._plane_index[0] != self._children_stamp()):
+                    self._build_plane_index()
+                    attempt = 1
+                index = self._plane_index[1]
+                if key not in index:
+                    # remembered until the children change
+                    index[key] = None
+                    return None
+                if index[key] is None:
+                    return None
+                position, node = index[key]
+                if hasattr(node, "getparent"):
+                    in_place = node.getparent() is self.node
+                else:
+                    in_place = position < len(self.node) and self.node[position] is node
+                plane = OMEXML.Plane(node, self.ns)
+                if in_place and (plane.TheZ, plane.TheC, plane.TheT) == key:
+                    return plane
+                if attempt:
+                    return None
+                self._plane_index = None
+
+        def invalidate_plane_index(self):
+            '''Make plane_at rebuild its index on the next call'''
+            self._plane_index = None
+
+        def _children_stamp(self):
+            '''A cheap value that changes when children are added or removed
+
+            This is the last child, which changes when a child is appended
+            or the last one is removed or replaced, with the number of
+            children for ElementTree, which counts them in constant time.
+            lxml doesn't, so there plane_at also checks the found plane's
+            parent.
+            '''
+            try:
+                last = self.node[-1]
+            except IndexError:
+                last = None
+            if hasattr(self.node, "getparent"):
+                return last
+            return len(self.node), last
+
+        def _build_plane_index(self):
+            index = {}
+            for position, node in enumerate(self.node):
+                if node.tag == qn(self.ns['ome'], "Plane"):
+                    index.setdefault((get_int_attr(node, "TheZ"),
+                                      get_int_attr(node, "TheC"),
+                                      get_int_attr(node, "TheT")), (position, node))
+            self._plane_index = (self._children_stamp(), index)
         
         def get_tiffdata_count(self):
             return len(self.node.findall(qn(self.ns['ome'], "TiffData")))
 
         def set_tiffdata_count(self, value):
             assert value >= 0
-            tiffdatas = self.node.findall(qn(self.ns['ome'], "TiffData"))
-            for td in tiffdatas:
-                self.node.remove(td)
-            for _ in range(0, value):
-                new_tiffdata = OMEXML.TiffData(
-                    ElementTree.SubElement(self.node, qn(self.ns['ome'], "TiffData")))
+            resize_children(self.node, qn(self.ns['ome'], "TiffData"), value,
+                            before=[qn(self.ns['ome'], "Plane")])
 
         tiffdata_count = property(get_tiffdata_count, set_tiffdata_count)
 
         def tiffdata(self, index=0):
             data = self.node.findall(qn(self.ns['ome'], "TiffData"))[index]
-            return OMEXML.TiffData(data)
+            return OMEXML.TiffData(data, self.ns)
+
+        def _tiffdata_runs(self, clip=True):
+            '''The TiffData elements and the planes and IFDs each covers
+
+            clip - cut runs short at the last plane and give TiffData
+                   whose first plane is out of range no planes. Otherwise
+                   the first plane of those is -1 and PlaneCount is as given.
+
+            Returns the TiffData nodes and arrays of the index of each one's
+            first plane in DimensionOrder, its first IFD and its number of
+            planes. FirstZ, FirstC, FirstT and IFD default to 0. A missing
+            PlaneCount is 1, except for a TiffData without an IFD either,
+            which stands for all IFDs of its file: it covers the planes up to
+            the first plane of the next TiffData in DimensionOrder, or to the
+            last plane, e.g. with one file per T:
+
+            <TiffData FirstT="1"><UUID FileName="t1.ome.tif">...</UUID></TiffData>
+            '''
+            require_numpy()
+            nodes = self.node.findall(qn(self.ns['ome'], "TiffData"))
+            sizes = (self.SizeZ, self.SizeC, self.SizeT)
+            # IFD and PlaneCount can't be negative, so -1 marks them missing
+            first_z, first_c, first_t, ifd, count = get_children_attributes(
+                nodes, [("FirstZ", "i8", "0"), ("FirstC", "i8", "0"),
+                        ("FirstT", "i8", "0"), ("IFD", "i8", "-1"),
+                        ("PlaneCount", "i8", "-1")])
+            whole_file = (ifd == -1) & (count == -1)
+            ifd = np.where(ifd == -1, 0, ifd)
+            count = np.where(count == -1, 1, count)
+            in_range = np.ones(len(nodes), dtype=bool)
+            for values, size in zip((first_z, first_c, first_t), sizes):
+                in_range &= (values >= 0) & (values < size)
+            start = np.where(in_range, index_from_zct(
+                self.DimensionOrder, *(sizes + (first_z, first_c, first_t))), -1)
+            total = sizes[0] * sizes[1] * sizes[2]
+            if whole_file.any():
+                starts = np.unique(np.concatenate((start[in_range], [total])))
+                following = starts[np.minimum(
+                    np.searchsorted(starts, start, side="right"), len(starts) - 1)]
+                count = np.where(whole_file, np.where(in_range, following - start, 0),
+                                 count)
+            if clip:
+                count = np.where(in_range, np.clip(
+                    np.minimum(count, total - start), 0, None), 0)
+            return nodes, start, ifd, count
+
+        def _tiffdata_file(self, node):
+            '''The FileName and UUID text of a TiffData node, or Nones'''
+            uuid_node = node.find(qn(self.ns['ome'], "UUID"))
+            if uuid_node is None:
+                return None, None
+            return uuid_node.get("FileName"), uuid_node.text
+
+        def compact_tiffdata(self):
+            '''Merge TiffData for consecutive planes and IFDs into runs
+
+            A TiffData whose planes follow on, in DimensionOrder, from those
+            of the TiffData before it and whose IFDs follow on from that
+            one's IFDs in the same file is merged into it, so that a
+            TiffData per plane becomes one TiffData with PlaneCount planes
+            per run. Returns the new number of TiffData elements.
+            '''
+            nodes, start, ifd, count = self._tiffdata_runs()
+            if len(nodes) < 2:
+                return len(nodes)
+            files = [self._tiffdata_file(node) for node in nodes]
+            follows = (start[1:] == start[:-1] + count[:-1]) & \
+                      (ifd[1:] == ifd[:-1] + count[:-1]) & (count[:-1] > 0) & \
+                      np.array([a == b for a, b in zip(files[:-1], files[1:])], dtype=bool)
+            firsts = np.flatnonzero(np.concatenate(([True], ~follows)))
+            totals = np.add.reduceat(count, firsts)
+            kept = []
+            for first, total in zip(firsts.tolist(), totals.tolist()):
+                node = nodes[first]
+                if total != count[first]:
+                    node.set("PlaneCount", str(total))
+                kept.append(node)
+            replace_children(self.node, qn(self.ns['ome'], "TiffData"), kept)
+            return len(kept)
+
+        def expand_tiffdata(self):
+            '''Split TiffData runs into one TiffData per plane
+
+            This is the inverse of compact_tiffdata: each TiffData with
+            several planes is replaced by TiffData with PlaneCount="1" and
+            the FirstZ, FirstC, FirstT and IFD of each plane. Other
+            attributes and the UUID are copied to all of them. Returns the
+            new number of TiffData elements.
+            '''
+            nodes, start, ifd, count = self._tiffdata_runs()
+            if (count == 1).all() and all(
+                    node.get("PlaneCount") is not None for node in nodes):
+                return len(nodes)
+            new = []
+            for node, first, first_ifd, n in zip(
+                    nodes, start.tolist(), ifd.tolist(), count.tolist()):
+                if n <= 1:
+                    if n == 1:
+                        node.set("PlaneCount", "1")
+                    new.append(node)
+                    continue
+                z, c, t = zct_from_index(self.DimensionOrder, self.SizeZ, self.SizeC,
+                                         self.SizeT, np.arange(first, first + n))
+                columns = dict((name, [value] * n) for name, value in node.attrib.items())
+                columns.update(FirstZ=[str(value) for value in z.tolist()],
+                               FirstC=[str(value) for value in c.tolist()],
+                               FirstT=[str(value) for value in t.tolist()],
+                               IFD=[str(value) for value in range(first_ifd, first_ifd + n)],
+                               PlaneCount=["1"] * n)
+                elements = make_elements(self.node, node.tag, columns, n)
+                for child in node:
+                    for element in elements:
+                        element.append(copy.deepcopy(child))
+                new += elements
+            replace_children(self.node, qn(self.ns['ome'], "TiffData"), new)
+            return len(new)
+
+        def _tiffdata_planes(self):
+            '''Every plane with data, its IFD and the TiffData giving it
+
+            Returns the TiffData nodes and arrays of the index in
+            DimensionOrder of each plane with data, sorted, its IFD and the
+            index in nodes of its TiffData. Where TiffData overlap, the
+            first one wins.
+            '''
+            nodes, start, ifd, count = self._tiffdata_runs()
+            run = np.repeat(np.arange(len(nodes)), count)
+            # the offset of each covered plane within its run
+            offset = np.arange(len(run)) - np.repeat(np.cumsum(count) - count, count)
+            plane, first = np.unique(start[run] + offset, return_index=True)
+            return nodes, plane, ifd[run[first]] + offset[first], run[first]
+
+        def ifd_index(self):
+            '''The IFD of every plane as a (SizeZ, SizeC, SizeT) int array
+
+            The index is computed from the TiffData elements and the
+            DimensionOrder, with runs of PlaneCount planes mapped to
+            consecutive IFDs. Planes without data are -1. Where TiffData
+            overlap, the first one wins. Keep the array for random access:
+
+            >>> ifds = pixels.ifd_index()
+            >>> ifd = ifds[z, c, t]
+            '''
+            nodes, plane, ifd, run = self._tiffdata_planes()
+            total = self.SizeZ * self.SizeC * self.SizeT
+            by_plane = np.full(total, -1, dtype="i8")
+            by_plane[plane] = ifd
+            index = np.empty((self.SizeZ, self.SizeC, self.SizeT), dtype="i8")
+            index[zct_from_index(self.DimensionOrder, self.SizeZ, self.SizeC,
+                                 self.SizeT, np.arange(total))] = by_plane
+            return index
+
+        def ifd_to_zct(self, file_name=None, n_ifds=None):
+            '''The (Z, C, T) of every IFD as an (n_ifds, 3) int array
+
+            file_name - only use the TiffData for this file (their UUID
+                        FileName). By default all TiffData are used, which
+                        suits single file datasets.
+            n_ifds - the number of rows, by default one more than the
+                     highest IFD
+
+            Rows of IFDs without a plane are -1. This is the inverse of
+            ifd_index, for reading the IFDs of a file in order:
+
+            >>> zct = pixels.ifd_to_zct("img_t0.ome.tif")
+            >>> for ifd, (z, c, t) in enumerate(zct): ...
+            '''
+            nodes, plane, ifd, run = self._tiffdata_planes()
+            if file_name is not None:
+                in_file = np.array([self._tiffdata_file(node)[0] == file_name
+                                    for node in nodes], dtype=bool)
+                plane, ifd = plane[in_file[run]], ifd[in_file[run]]
+            if n_ifds is None:
+                n_ifds = int(ifd.max()) + 1 if len(ifd) else 0
+            plane, ifd = plane[ifd < n_ifds], ifd[ifd < n_ifds]
+            zct = np.full((n_ifds, 3), -1, dtype="i8")
+            # assigned in reverse so that the first plane for an IFD is kept
+            zct[ifd[::-1]] = np.stack(zct_from_index(
+                self.DimensionOrder, self.SizeZ, self.SizeC, self.SizeT,
+                plane[::-1]), axis=1)
+            return zct
+
+        def plane_table(self, names=None):
+            '''The attributes of all planes as a numpy structured array
+
+            names - the fields wanted, by default all of PLANE_TABLE_COLUMNS
+
+            There is one record per Plane, in document order, with a field
+            for each of PLANE_TABLE_COLUMNS. Missing indices are -1, missing
+            times and positions are NaN and missing units are "".
+            The planes are found once and each column is converted in
+            one numpy call, so this is linear in the number of planes.
+
+            >>> table = pixels.plane_table()
+            >>> table["DeltaT"][table["TheC"] == 0]
+            '''
+            require_numpy()
+            planes = self.node.findall(qn(self.ns['ome'], "Plane"))
+            wanted = [column for column in PLANE_TABLE_COLUMNS
+                      if names is None or column[0] in names]
+            columns = list(zip([name for name, dtype, missing in wanted],
+                               get_children_attributes(planes, wanted)))
+            table = np.empty(len(planes), dtype=[
+                (name, values.dtype) for name, values in columns])
+            for name, values in columns:
+                table[name] = values
+            return table
+
+        def timing_summary(self, gap_factor=1.5):
+            '''Frame interval statistics and total exposure per channel and Z
+
+            gap_factor - an interval longer than gap_factor times the median
+                         interval of its channel and Z is reported as a gap
+
+            Returns a list of dictionaries, one for each TheC and TheZ in
+            that order, with keys TheC, TheZ, PlaneCount, IntervalMin,
+            IntervalMax, IntervalMean, IntervalStd, FrameRate, Gaps,
+            TotalExposure, DeltaTUnit and ExposureTimeUnit. Intervals are the
+            differences between the sorted DeltaT values of the planes, in
+            DeltaTUnit, and are NaN if there are fewer than two times. Gaps is
+            a list of (TheT, interval) for the plane after each gap.
+            TotalExposure is the sum of the ExposureTime values. Units are
+            the schema default "s" if not given and must not be mixed
+            within a channel and Z. Seven attributes of every plane are read,
+            which takes about 145 ms with ElementTree and 280 ms with lxml
+            for 100,000 planes.
+
+            >>> for summary in pixels.timing_summary():
+            ...     print(summary["TheC"], summary["FrameRate"], summary["Gaps"])
+            '''
+            table = self.plane_table(("TheZ", "TheC", "TheT", "DeltaT", "DeltaTUnit",
+                                      "ExposureTime", "ExposureTimeUnit"))
+            if len(table) == 0:
+                return []
+            # by channel, then Z, then time, with planes without DeltaT last
+            table = table[np.lexsort((table["DeltaT"], table["TheZ"], table["TheC"]))]
+            keys = np.stack((table["TheC"], table["TheZ"]), axis=1)
+            starts = np.flatnonzero(np.concatenate(
+                ([True], np.any(keys[1:] != keys[:-1], axis=1))))
+            summaries = []
+            for start, stop in zip(starts, np.append(starts[1:], len(table))):
+                group = table[start:stop]
+                units = {}
+                for name in ("DeltaTUnit", "ExposureTimeUnit"):
+                    values = set(np.unique(group[name]).tolist()) - set([""])
+                    if len(values) > 1:
+                        raise ValueError(
+                            "Mixed %s for TheC=%d, TheZ=%d: %s" %
+                            (name, group["TheC"][0], group["TheZ"][0],
+                             ", ".join(sorted(values))))
+                    units[name] = values.pop() if values else "s"
+                times = group["DeltaT"][~np.isnan(group["DeltaT"])]
+                intervals = np.diff(times)
+                if len(intervals):
+                    mean = intervals.mean()
+                    gaps = np.flatnonzero(
+                        intervals > gap_factor * np.median(intervals))
+                    statistics = (intervals.min(), intervals.max(), mean,
+                                  intervals.std(), 1.0 / mean if mean else np.inf)
+                else:
+                    gaps = []
+                    statistics = (np.nan,) * 5
+                summaries.append(dict(
+                    zip(("IntervalMin", "IntervalMax", "IntervalMean",
+                         "IntervalStd", "FrameRate"),
+                        [float(value) for value in statistics]),
+                    TheC=int(group["TheC"][0]),
+                    TheZ=int(group["TheZ"][0]),
+                    PlaneCount=len(group),
+                    Gaps=[(int(group["TheT"][i + 1]), float(intervals[i]))
+                          for i in gaps],
+                    TotalExposure=float(np.nansum(group["ExposureTime"])),
+                    **units))
+            return summaries
+
+        def stage_track(self, unit="\u00b5m"):
+            '''The stage positions of all planes in one unit
+
+            unit - a unit of LENGTH_UNITS to convert the positions to
+
+            Returns an (N, 3) float array of PositionX, PositionY and
+            PositionZ for the N planes in document order and an (N, 3)
+            boolean array that is True where a position is missing (and NaN
+            in the positions). Each position is converted from its own unit.
+            Positions in "pixel" or "reference frame", the default when there
+            is no unit, can't be converted, so they are NaN and marked
+            missing too; read them with plane_table if they are wanted.
+
+            >>> positions, missing = pixels.stage_track("mm")
+            '''
+            if unit not in LENGTH_UNITS:
+                raise ValueError("Unknown length unit '%s'" % unit)
+            table = self.plane_table(
+                [name + suffix for name in ("PositionX", "PositionY", "PositionZ")
+                 for suffix in ("", "Unit")])
+            positions = np.empty((len(table), 3))
+            for i, name in enumerate(("PositionX", "PositionY", "PositionZ")):
+                units, inverse = np.unique(table[name + "Unit"], return_inverse=True)
+                scales = []
+                for value in units.tolist():
+                    if value in LENGTH_UNITS:
+                        scales.append(LENGTH_UNITS[value] / LENGTH_UNITS[unit])
+                    elif value in UNCONVERTED_LENGTH_UNITS or value == "":
+                        scales.append(np.nan)
+                    else:
+                        raise ValueError("Unknown %sUnit '%s'" % (name, value))
+                positions[:, i] = table[name] * np.array(scales)[inverse.ravel()]
+            return positions, np.isnan(positions)
+
+        def set_planes(self, **columns):
+            '''Create or overwrite all Plane elements from columns of values
+
+            Keywords are the Plane attributes in PLANE_TABLE_COLUMNS, e.g.
+            TheZ, TheC, TheT, DeltaT, ExposureTime, PositionX and
+            PositionXUnit. Each is a sequence or array with one value per
+            plane, or a single value (e.g. a unit) for every plane. None and
+            NaN values remove the attribute. plane_count is set to the length
+            of the sequences, and attributes that aren't given are left as
+            they are on existing planes.
+
+            >>> pixels.set_planes(TheZ=z, TheC=c, TheT=t, DeltaT=times,
+            ...                   DeltaTUnit="s")
+            '''
+            self._plane_index = None
+            names = set(name for name, dtype, missing in PLANE_TABLE_COLUMNS)
+            unknown = set(columns) - names
+            if unknown:
+                raise TypeError("Unknown Plane attributes: %s" % ", ".join(sorted(unknown)))
+            set_children_attributes(self.node, qn(self.ns['ome'], "Plane"), columns)
+
+        def set_tiffdata(self, first_z=None, first_c=None, first_t=None, ifd=None,
+                         plane_count=None):
+            '''Create or overwrite all TiffData elements from columns of values
+
+            first_z, first_c, first_t, ifd, plane_count - sequences or arrays
+                with one FirstZ, FirstC, FirstT, IFD and PlaneCount per
+                TiffData, or single values for all of them
+
+            As with set_planes, tiffdata_count is set to the length of the
+            sequences and None and NaN values in them remove the attribute.
+            Attributes whose argument is None, the default, are left as
+            they are. The UUID of existing TiffData is kept.
+
+            >>> pixels.set_tiffdata(first_z=z, first_c=c, first_t=t,
+            ...                     ifd=np.arange(len(z)), plane_count=1)
+            '''
+            columns = {"FirstZ": first_z, "FirstC": first_c, "FirstT": first_t,
+                       "IFD": ifd, "PlaneCount": plane_count}
+            set_children_attributes(
+                self.node, qn(self.ns['ome'], "TiffData"),
+                dict((name, values) for name, values in columns.items()
+                     if values is not None),
+                before=[qn(self.ns['ome'], "Plane")])
 
     class Instrument(object):
         '''Representation of the OME/Instrument element'''
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_ID(self):
             return self.node.get("ID")
@@ -949,21 +2539,21 @@ class OMEXML(object):
 
         @property
         def Detector(self):
-            return OMEXML.Detector(self.node.find(qn(self.ns['ome'], "Detector")))
+            return OMEXML.Detector(self.node.find(qn(self.ns['ome'], "Detector")), self.ns)
         
         @property
         def Objective(self):
-            return OMEXML.Objective(self.node.find(qn(self.ns['ome'], "Objective")))
+            return OMEXML.Objective(self.node.find(qn(self.ns['ome'], "Objective")), self.ns)
 
 
     def instrument(self, index=0):
-        return self.Instrument(self.root_node.findall(qn(self.ns['ome'], "Instrument"))[index])
+        return self.Instrument(self.root_node.findall(qn(self.ns['ome'], "Instrument"))[index], self.ns)
 
 
     class Objective(object):
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_ID(self):
             return self.node.get("ID")
@@ -991,9 +2581,9 @@ class OMEXML(object):
         WorkingDistanceUnit = property(get_WorkingDistanceUnit, set_WorkingDistanceUnit)
     
     class Detector(object):
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_ID(self):
             return self.node.get("ID")
@@ -1042,9 +2632,9 @@ class OMEXML(object):
 
         '''
 
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def __getitem__(self, key):
             for child in self.node:
@@ -1074,16 +2664,16 @@ class OMEXML(object):
 
             returns the ID for the structured annotation.
             '''
-            xml_annotation = ElementTree.SubElement(
+            xml_annotation = sub_element(
                 self.node, qn(self.ns['sa'], "XMLAnnotation"))
             node_id = str(uuid.uuid4())
             xml_annotation.set("ID", node_id)
-            xa_value = ElementTree.SubElement(xml_annotation, qn(self.ns['sa'], "Value"))
-            ov = ElementTree.SubElement(
+            xa_value = sub_element(xml_annotation, qn(self.ns['sa'], "Value"))
+            ov = sub_element(
                 xa_value, qn(NS_ORIGINAL_METADATA, "OriginalMetadata"))
-            ov_key = ElementTree.SubElement(ov, qn(NS_ORIGINAL_METADATA, "Key"))
+            ov_key = sub_element(ov, qn(NS_ORIGINAL_METADATA, "Key"))
             set_text(ov_key, key)
-            ov_value = ElementTree.SubElement(
+            ov_value = sub_element(
                 ov, qn(NS_ORIGINAL_METADATA, "Value"))
             set_text(ov_value, value)
             return node_id
@@ -1210,27 +2800,27 @@ class OMEXML(object):
 
     class PlatesDucktype(object):
         '''It looks like a list of plates'''
-        def __init__(self, root):
+        def __init__(self, root, ns=None):
             self.root = root
-            self.ns = get_namespaces(self.root)
+            self.ns = get_namespaces(self.root) if ns is None else ns
 
         def __getitem__(self, key):
             plates = self.root.findall(qn(self.ns['spw'], "Plate"))
             if isinstance(key, slice):
-                return [OMEXML.Plate(plate) for plate in plates[key]]
-            return OMEXML.Plate(plates[key])
+                return [OMEXML.Plate(plate, self.ns) for plate in plates[key]]
+            return OMEXML.Plate(plates[key], self.ns)
 
         def __len__(self):
             return len(self.root.findall(qn(self.ns['spw'], "Plate")))
 
         def __iter__(self):
             for plate in self.root.iterfind(qn(self.ns['spw'], "Plate")):
-                yield OMEXML.Plate(plate)
+                yield OMEXML.Plate(plate, self.ns)
 
         def newPlate(self, name, plate_id = str(uuid.uuid4())):
-            new_plate_node = ElementTree.SubElement(
+            new_plate_node = sub_element(
                 self.root, qn(self.ns['spw'], "Plate"))
-            new_plate = OMEXML.Plate(new_plate_node)
+            new_plate = OMEXML.Plate(new_plate_node, self.ns)
             new_plate.ID = plate_id
             new_plate.Name = name
             return new_plate
@@ -1241,9 +2831,9 @@ class OMEXML(object):
         This represents the plate element of the SPW schema:
         http://www.openmicroscopy.org/Schemas/SPW/2007-06/
         '''
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_ID(self):
             return self.node.get("ID")
@@ -1370,7 +2960,7 @@ class OMEXML(object):
         def __init__(self, plate):
             self.plate_node = plate.node
             self.plate = plate
-            self.ns = get_namespaces(self.plate_node)
+            self.ns = plate.ns
 
         def __len__(self):
             return len(self.plate_node.findall(qn(self.ns['spw'], "Well")))
@@ -1378,16 +2968,16 @@ class OMEXML(object):
         def __getitem__(self, key):
             all_wells = self.plate_node.findall(qn(self.ns['spw'], "Well"))
             if isinstance(key, slice):
-                return [OMEXML.Well(w) for w in all_wells[key]]
+                return [OMEXML.Well(w, self.ns) for w in all_wells[key]]
             if hasattr(key, "__len__") and len(key) == 2:
-                well = OMEXML.Well(None)
+                well = OMEXML.Well(None, self.ns)
                 for w in all_wells:
                     well.node = w
                     if well.Row == key[0] and well.Column == key[1]:
                         return well
             if isinstance(key, int):
-                return OMEXML.Well(all_wells[key])
-            well = OMEXML.Well(None)
+                return OMEXML.Well(all_wells[key], self.ns)
+            well = OMEXML.Well(None, self.ns)
             for w in all_wells:
                 well.node = w
                 if self.plate.get_well_name(well) == key:
@@ -1403,7 +2993,7 @@ class OMEXML(object):
             with the standard row and column naming convention
             '''
             all_wells = self.plate_node.findall(qn(self.ns['spw'], "Well"))
-            well = OMEXML.Well(None)
+            well = OMEXML.Well(None, self.ns)
             for w in all_wells:
                 well.node = w
                 yield self.plate.get_well_name(well)
@@ -1415,17 +3005,18 @@ class OMEXML(object):
             column - index of well's column
             well_id - the ID attribute for the well
             '''
-            well_node = ElementTree.SubElement(
+            well_node = sub_element(
                 self.plate_node, qn(self.ns['spw'], "Well"))
-            well = OMEXML.Well(well_node)
+            well = OMEXML.Well(well_node, self.ns)
             well.Row = row
             well.Column = column
             well.ID = well_id
             return well
 
     class Well(object):
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
+            self.ns = ns
 
         def get_Column(self):
             return get_int_attr(self.node, "Column")
@@ -1446,7 +3037,7 @@ class OMEXML(object):
         ID = property(get_ID, set_ID)
 
         def get_Sample(self):
-            return OMEXML.WellSampleDucktype(self.node)
+            return OMEXML.WellSampleDucktype(self.node, self.ns)
         Sample = property(get_Sample)
 
         def get_ExternalDescription(self):
@@ -1480,9 +3071,9 @@ class OMEXML(object):
         things like:
         wellsamples[0:2]
         '''
-        def __init__(self, well_node):
+        def __init__(self, well_node, ns=None):
             self.well_node = well_node
-            self.ns = get_namespaces(self.well_node)
+            self.ns = get_namespaces(self.well_node) if ns is None else ns
 
         def __len__(self):
             return len(self.well_node.findall(qn(self.ns['spw'], "WellSample")))
@@ -1490,32 +3081,32 @@ class OMEXML(object):
         def __getitem__(self, key):
             all_samples = self.well_node.findall(qn(self.ns['spw'], "WellSample"))
             if isinstance(key, slice):
-                return [OMEXML.WellSample(s)
+                return [OMEXML.WellSample(s, self.ns)
                         for s in all_samples[key]]
-            return OMEXML.WellSample(all_samples[int(key)])
+            return OMEXML.WellSample(all_samples[int(key)], self.ns)
 
         def __iter__(self):
             '''Iterate through the well samples.'''
             all_samples = self.well_node.findall(qn(self.ns['spw'], "WellSample"))
             for s in all_samples:
-                yield OMEXML.WellSample(s)
+                yield OMEXML.WellSample(s, self.ns)
 
         def new(self, wellsample_id = str(uuid.uuid4()), index = None):
             '''Create a new well sample
             '''
             if index is None:
                 index = reduce(max, [s.Index for s in self], -1) + 1
-            new_node = ElementTree.SubElement(
+            new_node = sub_element(
                 self.well_node, qn(self.ns['spw'], "WellSample"))
-            s = OMEXML.WellSample(new_node)
+            s = OMEXML.WellSample(new_node, self.ns)
             s.ID = wellsample_id
             s.Index = index
 
     class WellSample(object):
         '''The WellSample is a location within a well'''
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_ID(self):
             return self.node.get("ID")
@@ -1564,15 +3155,15 @@ class OMEXML(object):
             '''Add a reference to the image of this site'''
             ref = self.node.find(qn(self.ns['spw'], "ImageRef"))
             if ref is None:
-                ref = ElementTree.SubElement(self.node, qn(self.ns['spw'], "ImageRef"))
+                ref = sub_element(self.node, qn(self.ns['spw'], "ImageRef"))
             ref.set("ID", value)
         ImageRef = property(get_ImageRef, set_ImageRef)
 
     class ROIRef(object):
 
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_ID(self):
             return self.node.get("ID")
@@ -1588,11 +3179,13 @@ class OMEXML(object):
         ID = property(get_ID, set_ID)
 
     def get_roi_count(self):
+        self._load_deferred("roi")
         return len(self.root_node.findall(qn(self.ns['ome'], "ROI")))
 
     def set_roi_count(self, value):
         '''Add or remove roi nodes as needed'''
         assert value > 0
+        self._load_deferred("roi")
         root = self.root_node
         if self.roi_count > value:
             roi_nodes = root.find(qn(self.ns['ome'], "ROI"))
@@ -1601,13 +3194,13 @@ class OMEXML(object):
         while(self.roi_count < value):
             iteration = self.roi_count - 1
 
-            new_roi = self.ROI(ElementTree.SubElement(root, qn(self.ns['ome'], "ROI")))
+            new_roi = self.ROI(sub_element(root, qn(self.ns['ome'], "ROI")), self.ns)
             new_roi.ID = str(iteration)
             new_roi.Name = "Marker " + str(iteration)
             new_Union = self.Union(
-                ElementTree.SubElement(new_roi.node, qn(self.ns['ome'], "Union")))
+                sub_element(new_roi.node, qn(self.ns['ome'], "Union")), self.ns)
             new_Rectangle = self.Rectangle(
-                ElementTree.SubElement(new_Union.node, qn(self.ns['ome'], "Rectangle")))
+                sub_element(new_Union.node, qn(self.ns['ome'], "Rectangle")), self.ns)
             new_Rectangle.set_ID("Shape:" + str(iteration) + ":0")
             new_Rectangle.set_TheZ(0)
             new_Rectangle.set_TheC(0)
@@ -1624,13 +3217,14 @@ class OMEXML(object):
     
     def roi(self, index=0):
         '''Return an ROI node by index'''
-        return self.ROI(self.root_node.findall(qn(self.ns['ome'], "ROI"))[index])
+        self._load_deferred("roi")
+        return self.ROI(self.root_node.findall(qn(self.ns['ome'], "ROI"))[index], self.ns)
 
     class ROI(object):
 
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_ID(self):
             return self.node.get("ID")
@@ -1656,23 +3250,23 @@ class OMEXML(object):
         @property
         def Union(self):
             '''The OME/ROI/Union element.'''
-            return OMEXML.Union(self.node.find(qn(self.ns['ome'], "Union")))
+            return OMEXML.Union(self.node.find(qn(self.ns['ome'], "Union")), self.ns)
 
     class Union(object):
 
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def Rectangle(self):
             '''The OME/ROI/Union element. Currently only rectangle ROIs are available.'''
-            return OMEXML.Rectangle(self.node.find(qn(self.ns['ome'], "Rectangle")))
+            return OMEXML.Rectangle(self.node.find(qn(self.ns['ome'], "Rectangle")), self.ns)
 
     class Rectangle(object):
 
-        def __init__(self, node):
+        def __init__(self, node, ns=None):
             self.node = node
-            self.ns = get_namespaces(self.node)
+            self.ns = get_namespaces(self.node) if ns is None else ns
 
         def get_ID(self):
             return self.node.get("ID")
@@ -1770,3 +3364,177 @@ class OMEXML(object):
             self.node.set("TheT", str(value))
 
         TheT = property(get_TheT, set_TheT)
+
+class TiffDatasetIndex(object):
+    '''Where the planes of a (possibly multi-file) OME-TIFF dataset are
+
+    Made by OMEXML.tiff_dataset_index. There is one entry for each plane
+    with data, sorted by image and then by plane in DimensionOrder, in the
+    numpy arrays image, z, c, t, ifd and file. file indexes files, a list
+    of (file name, UUID) for each distinct file; planes in the file
+    holding the OME-XML, which have no UUID, have (None, None).
+    '''
+    def __init__(self, omexml):
+        require_numpy()
+        self.files = []
+        file_ids = {}
+        columns = dict((name, []) for name in ("image", "z", "c", "t", "ifd", "file"))
+        self._offsets = []
+        self._sizes = []
+        dense_ifd = []
+        dense_file = []
+        offset = 0
+        for image_index, image in enumerate(
+                omexml.root_node.iterfind(qn(omexml.ns['ome'], "Image"))):
+            pixels = OMEXML.Image(image, omexml.ns).Pixels
+            sizes = (pixels.SizeZ, pixels.SizeC, pixels.SizeT)
+            nodes, plane, ifd, run = pixels._tiffdata_planes()
+            run_files = []
+            for node in nodes:
+                key = pixels._tiffdata_file(node)
+                if key not in file_ids:
+                    file_ids[key] = len(self.files)
+                    self.files.append(key)
+                run_files.append(file_ids[key])
+            file_id = np.array(run_files, dtype="i8")[run]
+            z, c, t = zct_from_index(pixels.DimensionOrder, *(sizes + (plane,)))
+            for name, values in (("image", np.full(len(plane), image_index)),
+                                 ("z", z), ("c", c), ("t", t),
+                                 ("ifd", ifd), ("file", file_id)):
+                columns[name].append(values)
+            # (z, c, t) in C order after offset, for lookup
+            total = sizes[0] * sizes[1] * sizes[2]
+            flat = (z * sizes[1] + c) * sizes[2] + t
+            for dense, values in ((dense_ifd, ifd), (dense_file, file_id)):
+                array = np.full(total, -1, dtype="i8")
+                array[flat] = values
+                dense.append(array)
+            self._offsets.append(offset)
+            self._sizes.append(sizes)
+            offset += total
+        for name, values in columns.items():
+            setattr(self, name, np.concatenate(values).astype("i8") if values
+                    else np.zeros(0, dtype="i8"))
+        self._ifd = np.concatenate(dense_ifd) if dense_ifd else np.zeros(0, dtype="i8")
+        self._file = np.concatenate(dense_file) if dense_file else np.zeros(0, dtype="i8")
+
+    def __len__(self):
+        return len(self.ifd)
+
+    def lookup(self, image, z, c, t):
+        '''The (file name, UUID, IFD) of a plane, or None if it has no data
+
+        image - the index of the image
+        z, c, t - the plane's indices
+        '''
+        size_z, size_c, size_t = self._sizes[image]
+        if not (0 <= z < size_z and 0 <= c < size_c and 0 <= t < size_t):
+            raise IndexError("(%d, %d, %d) is outside image %d" % (z, c, t, image))
+        flat = self._offsets[image] + (z * size_c + c) * size_t + t
+        ifd = self._ifd[flat]
+        if ifd < 0:
+            return None
+        file_name, file_uuid = self.files[self._file[flat]]
+        return file_name, file_uuid, int(ifd)
+
+class OMEXMLCache(object):
+    '''A least-recently-used cache of parsed OMEXML documents
+
+    Documents are keyed by a SHA-1 hash of their XML bytes or, for files, by
+    (path, size, modification time), so an edited file is parsed again.
+
+    >>> cache = OMEXMLCache(maxsize=64)
+    >>> o = cache.get_tiff("tomo_0001.ome.tif")
+    >>> cache.hits, cache.misses
+
+    By default every call returns a copy of the cached document, which
+    the caller may modify freely. With copy=False the cached instance
+    itself is returned; it is shared by every caller and must be treated
+    as read-only.
+    '''
+    def __init__(self, maxsize=128, copy=True, backend=None):
+        '''maxsize - the number of documents to keep
+        copy - whether to hand out copies rather than the cached instances
+        backend - the XML backend used to parse, see get_backend
+        '''
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.copy = copy
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._documents = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    @staticmethod
+    def xml_key(xml):
+        '''The cache key for OME-XML text or a buffer'''
+        if not isinstance(xml, bytes) and hasattr(xml, "encode"):
+            xml = xml.encode("utf-8")
+        with memoryview(xml) as view:
+            return ("xml", hashlib.sha1(view).hexdigest())
+
+    @staticmethod
+    def file_key(path):
+        '''The cache key for a file, which changes when the file does'''
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        return ("file", path, stat.st_size, stat.st_mtime)
+
+    def get(self, xml):
+        '''Return the document for OME-XML text or a buffer'''
+        return self._get(self.xml_key(xml),
+                         lambda: OMEXML(xml, backend=self.backend))
+
+    def get_file(self, path):
+        '''Return the document for an OME-XML file (see OMEXML.from_file)'''
+        return self._get(self.file_key(path),
+                         lambda: OMEXML.from_file(path, backend=self.backend))
+
+    def get_tiff(self, path):
+        '''Return the document for an OME-TIFF file (see OMEXML.from_tiff)'''
+        return self._get(self.file_key(path),
+                         lambda: OMEXML.from_tiff(path, backend=self.backend))
+
+    def _get(self, key, load):
+        with self._lock:
+            document = self._documents.pop(key, None)
+            if document is not None:
+                self.hits += 1
+                self._documents[key] = document
+        if document is None:
+            # parse outside the lock so that other documents can be served
+            document = load()
+            with self._lock:
+                self.misses += 1
+                self._documents[key] = document
+                while len(self._documents) > self.maxsize:
+                    self._documents.popitem(last=False)
+        return document.copy() if self.copy else document
+
+    def invalidate(self, xml=None, path=None):
+        '''Drop the document for xml, or every cached version of a file
+
+        With neither argument, the cache is emptied.
+        '''
+        with self._lock:
+            if xml is None and path is None:
+                self._documents.clear()
+                return
+            if xml is not None:
+                self._documents.pop(self.xml_key(xml), None)
+            if path is not None:
+                path = os.path.abspath(path)
+                for key in [key for key in self._documents
+                            if key[0] == "file" and key[1] == path]:
+                    del self._documents[key]
+
+    def clear(self):
+        '''Empty the cache and reset the hit and miss counters'''
+        with self._lock:
+            self._documents.clear()
+            self.hits = 0
+            self.misses = 0
@@ -17,18 +17,20 @@ setuptools.setup(
     extras_require={
         "test": [
             "pytest"
+        ],
+        "lxml": [
+            "lxml"
+        ],
+        "numpy": [
+            "numpy"
         ]
     },
-    install_requires=[
-        "future",
-    ],
     py_modules=["oxdls"],
     classifiers=[
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: BSD License",
         "Operating System :: OS Independent",
         "Topic :: Scientific/Engineering :: Bio-Informatics",
     ],
-    python_requires='>=2.7',
+    python_requires='>=3.6',
 )
@@ -0,0 +1,646 @@
+import io
+import itertools
+import mmap
+import re
+import struct
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import oxdls
+from oxdls import OMEXML
+
+BACKENDS = [oxdls.BACKEND_ETREE] + \
+    ([] if oxdls.lxml_etree is None else [oxdls.BACKEND_LXML])
+
+SIZES = (3, 2, 4)
+
+
+def reference_zct(dimension_order, size_z, size_c, size_t):
+    '''(Z, C, T) of every plane index, from nested loops over the dimensions'''
+    sizes = {"Z": size_z, "C": size_c, "T": size_t}
+    slowest, middle, fastest = reversed(dimension_order[2:])
+    zct = []
+    for i, j, k in itertools.product(range(sizes[slowest]), range(sizes[middle]),
+                                     range(sizes[fastest])):
+        coordinates = {slowest: i, middle: j, fastest: k}
+        zct.append((coordinates["Z"], coordinates["C"], coordinates["T"]))
+    return zct
+
+
+def make_pixels(backend, dimension_order=oxdls.DO_XYCZT, sizes=SIZES):
+    pixels = OMEXML(backend=backend).image().Pixels
+    pixels.DimensionOrder = dimension_order
+    pixels.SizeZ, pixels.SizeC, pixels.SizeT = sizes
+    return pixels
+
+
+@pytest.mark.parametrize("dimension_order", oxdls.DIMENSION_ORDERS)
+def test_zct_from_index(dimension_order):
+    z, c, t = oxdls.zct_from_index(dimension_order, *(SIZES + (np.arange(24),)))
+    assert list(zip(z.tolist(), c.tolist(), t.tolist())) == \
+        reference_zct(dimension_order, *SIZES)
+
+
+@pytest.mark.parametrize("dimension_order", oxdls.DIMENSION_ORDERS)
+def test_index_from_zct(dimension_order):
+    z, c, t = np.array(reference_zct(dimension_order, *SIZES)).T
+    index = oxdls.index_from_zct(dimension_order, *(SIZES + (z, c, t)))
+    assert index.tolist() == list(range(24))
+    assert oxdls.index_from_zct(dimension_order, *(SIZES + (2, 1, 3))) == 23
+
+
+def test_invalid_dimension_order():
+    with pytest.raises(ValueError):
+        oxdls.zct_from_index("XYZZT", 1, 1, 1, [0])
+    with pytest.raises(ValueError):
+        oxdls.index_from_zct("XYZZT", 1, 1, 1, 0, 0, 0)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("dimension_order", oxdls.DIMENSION_ORDERS)
+def test_populate_planes(backend, dimension_order):
+    pixels = make_pixels(backend, dimension_order)
+    pixels.populate_planes(DeltaT=np.arange(24) * 0.5)
+    assert pixels.plane_count == 24
+    planes = [pixels.Plane(i) for i in range(24)]
+    assert [(p.TheZ, p.TheC, p.TheT) for p in planes] == \
+        reference_zct(dimension_order, *SIZES)
+    assert [p.DeltaT for p in planes] == [i * 0.5 for i in range(24)]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_populate_planes_clears_old_planes(backend):
+    pixels = make_pixels(backend)
+    pixels.populate_planes(DeltaT=np.arange(24), ExposureTime=np.ones(24))
+    pixels.populate_planes()
+    assert pixels.plane_count == 24
+    assert all(pixels.Plane(i).DeltaT is None and
+               pixels.Plane(i).ExposureTime is None for i in range(24))
+
+
+def ifd_index_from_loops(pixels, tiffdata):
+    '''ifd_index computed plane by plane from (FirstZ, FirstC, FirstT, IFD, PlaneCount)'''
+    zct = reference_zct(pixels.DimensionOrder, pixels.SizeZ, pixels.SizeC, pixels.SizeT)
+    index = np.full((pixels.SizeZ, pixels.SizeC, pixels.SizeT), -1)
+    for first_z, first_c, first_t, ifd, count in tiffdata:
+        start = zct.index((first_z, first_c, first_t))
+        for offset, (z, c, t) in enumerate(zct[start:start + count]):
+            if index[z, c, t] == -1:
+                index[z, c, t] = ifd + offset
+    return index
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("dimension_order", oxdls.DIMENSION_ORDERS)
+def test_ifd_index_one_tiffdata_per_plane(backend, dimension_order):
+    pixels = make_pixels(backend, dimension_order)
+    z, c, t = np.array(reference_zct(dimension_order, *SIZES)).T
+    ifd = np.arange(24)[::-1]
+    pixels.set_tiffdata(first_z=z, first_c=c, first_t=t, ifd=ifd, plane_count=1)
+    assert (pixels.ifd_index()[z, c, t] == ifd).all()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("dimension_order", oxdls.DIMENSION_ORDERS)
+def test_ifd_index_plane_count_runs(backend, dimension_order):
+    pixels = make_pixels(backend, dimension_order)
+    zct = reference_zct(dimension_order, *SIZES)
+    # a gap after the first run, a run cut short at the last plane and a
+    # run overlapping the first one, which wins
+    tiffdata = [zct[0] + (10, 5), zct[8] + (0, 10), zct[20] + (100, 8),
+                zct[3] + (50, 2)]
+    first_z, first_c, first_t, ifd, count = zip(*tiffdata)
+    pixels.set_tiffdata(first_z, first_c, first_t, ifd, count)
+    assert (pixels.ifd_index() == ifd_index_from_loops(pixels, tiffdata)).all()
+
+    nodes, start, first_ifd, count = pixels._tiffdata_runs()
+    assert start.tolist() == [0, 8, 20, 3]
+    assert first_ifd.tolist() == [10, 0, 100, 50]
+    assert count.tolist() == [5, 10, 4, 2]
+    assert pixels._tiffdata_runs(clip=False)[3].tolist() == [5, 10, 8, 2]
+
+    nodes, plane, ifd, run = pixels._tiffdata_planes()
+    assert plane.tolist() == list(range(5)) + list(range(8, 18)) + list(range(20, 24))
+    assert ifd.tolist() == list(range(10, 15)) + list(range(10)) + list(range(100, 104))
+    assert run.tolist() == [0] * 5 + [1] * 10 + [2] * 4
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_ifd_index_out_of_range_tiffdata(backend):
+    pixels = make_pixels(backend)
+    pixels.set_tiffdata(first_z=[0, 3], first_c=0, first_t=0, ifd=[0, 1],
+                        plane_count=[1, 1])
+    nodes, start, ifd, count = pixels._tiffdata_runs()
+    assert start.tolist() == [0, -1] and count.tolist() == [1, 0]
+    index = pixels.ifd_index()
+    assert index[0, 0, 0] == 0 and (index == -1).sum() == 23
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("dimension_order", oxdls.DIMENSION_ORDERS)
+def test_ifd_index_lone_tiffdata(backend, dimension_order):
+    pixels = make_pixels(backend, dimension_order)
+    pixels.tiffdata_count = 1
+    index = pixels.ifd_index()
+    z, c, t = np.array(reference_zct(dimension_order, *SIZES)).T
+    assert (index[z, c, t] == np.arange(24)).all()
+
+    # a lone TiffData starting part way covers the remaining planes
+    z, c, t = reference_zct(dimension_order, *SIZES)[5]
+    pixels.set_tiffdata(first_z=z, first_c=c, first_t=t)
+    assert pixels._tiffdata_runs()[3].tolist() == [19]
+    assert (pixels.ifd_index() == ifd_index_from_loops(
+        pixels, [(z, c, t, 0, 19)])).all()
+
+    # but not when it has an IFD
+    pixels.set_tiffdata(ifd=0)
+    assert (pixels.ifd_index() >= 0).sum() == 1
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_ifd_index_no_tiffdata(backend):
+    pixels = make_pixels(backend)
+    assert (pixels.ifd_index() == -1).all()
+
+
+def tiffdata_attributes(pixels):
+    return [(td.FirstZ, td.FirstC, td.FirstT, td.IFD, td.plane_count, td.FileName)
+            for td in (pixels.tiffdata(i) for i in range(pixels.tiffdata_count))]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("dimension_order", oxdls.DIMENSION_ORDERS)
+def test_ifd_to_zct_inverts_ifd_index(backend, dimension_order):
+    pixels = make_pixels(backend, dimension_order)
+    z, c, t = np.array(reference_zct(dimension_order, *SIZES)).T
+    ifd = np.random.RandomState(0).permutation(24)
+    pixels.set_tiffdata(first_z=z, first_c=c, first_t=t, ifd=ifd, plane_count=1)
+    index = pixels.ifd_index()
+    zct = pixels.ifd_to_zct()
+    assert zct.shape == (24, 3)
+    assert (index[tuple(zct.T)] == np.arange(24)).all()
+    assert (pixels.ifd_to_zct(n_ifds=30)[24:] == -1).all()
+    assert (pixels.ifd_to_zct(n_ifds=10) == zct[:10]).all()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_ifd_to_zct_per_file(backend):
+    pixels = make_pixels(backend, oxdls.DO_XYZCT)
+    # one file per T, each with its planes from IFD 0
+    pixels.set_tiffdata(first_z=0, first_c=0, first_t=[0, 1, 2, 3], ifd=0, plane_count=6)
+    for i in range(4):
+        pixels.tiffdata(i).FileName = "img_t%d.ome.tif" % i
+    index = pixels.ifd_index()
+    for i in range(4):
+        zct = pixels.ifd_to_zct("img_t%d.ome.tif" % i)
+        assert zct.shape == (6, 3) and (zct[:, 2] == i).all()
+        assert (index[tuple(zct.T)] == np.arange(6)).all()
+    assert pixels.ifd_to_zct("other.ome.tif").shape == (0, 3)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("dimension_order", oxdls.DIMENSION_ORDERS)
+def test_compact_expand_round_trip(backend, dimension_order):
+    pixels = make_pixels(backend, dimension_order)
+    zct = reference_zct(dimension_order, *SIZES)
+    # IFDs break off at plane 10 and the file changes at plane 16
+    ifd = list(range(10)) + list(range(20, 26)) + list(range(8))
+    first_z, first_c, first_t = zip(*zct)
+    pixels.set_tiffdata(first_z, first_c, first_t, ifd, plane_count=1)
+    for i in range(24):
+        pixels.tiffdata(i).UUID = "urn:uuid:%d" % (i < 16)
+        pixels.tiffdata(i).FileName = "a.ome.tif" if i < 16 else "b.ome.tif"
+    expanded = tiffdata_attributes(pixels)
+    index = pixels.ifd_index()
+
+    assert pixels.compact_tiffdata() == 3
+    assert tiffdata_attributes(pixels) == [
+        zct[0] + (0, 10, "a.ome.tif"), zct[10] + (20, 6, "a.ome.tif"),
+        zct[16] + (0, 8, "b.ome.tif")]
+    assert (pixels.ifd_index() == index).all()
+    assert pixels.compact_tiffdata() == 3
+
+    assert pixels.expand_tiffdata() == 24
+    assert tiffdata_attributes(pixels) == expanded
+    assert (pixels.ifd_index() == index).all()
+    assert pixels.expand_tiffdata() == 24
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_expand_lone_tiffdata(backend):
+    pixels = make_pixels(backend)
+    pixels.tiffdata_count = 1
+    index = pixels.ifd_index()
+    assert pixels.expand_tiffdata() == 24
+    assert all(td.plane_count == 1 for td in
+               (pixels.tiffdata(i) for i in range(24)))
+    assert (pixels.ifd_index() == index).all()
+    assert pixels.compact_tiffdata() == 1
+    assert pixels.tiffdata().plane_count == 24
+    assert (pixels.ifd_index() == index).all()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("dimension_order", [oxdls.DO_XYZCT, oxdls.DO_XYCZT])
+def test_one_file_per_timepoint(backend, dimension_order):
+    # TiffData without IFD or PlaneCount stand for every IFD of their file
+    o = OMEXML(backend=backend)
+    pixels = o.image().Pixels
+    pixels.DimensionOrder = dimension_order
+    pixels.SizeZ, pixels.SizeC, pixels.SizeT = 3, 1, 2
+    pixels.populate_planes()
+    pixels.set_tiffdata(first_t=[0, 1])
+    uuids = ["urn:uuid:0000000%d-0000-0000-0000-000000000000" % i for i in range(2)]
+    for i in range(2):
+        pixels.tiffdata(i).UUID = uuids[i]
+        pixels.tiffdata(i).FileName = "t%d.ome.tif" % i
+    assert pixels._tiffdata_runs()[3].tolist() == [3, 3]
+    assert pixels.ifd_index().tolist() == [[[0, 0]], [[1, 1]], [[2, 2]]]
+    assert pixels.ifd_to_zct("t1.ome.tif").tolist() == [[0, 0, 1], [1, 0, 1], [2, 0, 1]]
+
+    o = OMEXML(str(o), backend=backend)
+    index = o.tiff_dataset_index()
+    assert len(index) == 6
+    assert index.lookup(0, 2, 0, 1) == ("t1.ome.tif", uuids[1], 2)
+    assert index.lookup(0, 1, 0, 0) == ("t0.ome.tif", uuids[0], 1)
+    assert o.check_consistency()[0]["Problems"] == []
+
+    # the last TiffData runs to the last plane, earlier ones to the next
+    pixels = o.image().Pixels
+    pixels.set_tiffdata(first_z=[1, 0], first_t=[0, 1])
+    assert pixels._tiffdata_runs()[3].tolist() == [2, 3]
+    assert pixels.ifd_index()[0, 0, 0] == -1
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_tiffdata_file_name_without_uuid(backend):
+    pixels = make_pixels(backend)
+    pixels.tiffdata_count = 1
+    tiffdata = pixels.tiffdata()
+    tiffdata.FileName = "a.ome.tif"
+    assert tiffdata.FileName == "a.ome.tif"
+    assert re.match("urn:uuid:[0-9a-f-]{36}$", tiffdata.UUID)
+    tiffdata.UUID = "urn:uuid:00000000-0000-0000-0000-000000000000"
+    tiffdata.FileName = "b.ome.tif"
+    assert (tiffdata.FileName, tiffdata.UUID) == \
+        ("b.ome.tif", "urn:uuid:00000000-0000-0000-0000-000000000000")
+
+
+LAZY_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06" xmlns:SA="http://www.openmicroscopy.org/Schemas/SA/2013-06">
+<Image ID="Image:0"><Pixels ID="Pixels:0" DimensionOrder="XYCZT" Type="uint8" SizeX="1" SizeY="1" SizeZ="1" SizeC="1" SizeT="1"/></Image>
+<!-- not a section: <ROI ID="ROI:9"> -->
+<SA:StructuredAnnotations><SA:XMLAnnotation ID="Annotation:0"><SA:Value><x/></SA:Value></SA:XMLAnnotation></SA:StructuredAnnotations>
+<ROI ID="ROI:0"><Union><Rectangle ID="Shape:0" X="1" Y="2" Width="3" Height="4"/></Union></ROI>
+<ROI ID="ROI:1"><Union><Rectangle ID="Shape:1" X="5" Y="6" Width="7" Height="8"/></Union></ROI>
+</OME>'''
+
+
+def test_scan_deferred_sections():
+    xml = LAZY_XML.encode("utf-8")
+    head, tail, skeleton, deferred = oxdls.scan_deferred_sections(xml)
+    assert head.startswith(b"<OME ") and head.endswith(b">")
+    assert tail == b"</OME>"
+    sa_start, sa_stop = deferred["sa"]
+    roi_start, roi_stop = deferred["roi"]
+    assert xml[sa_start:].startswith(b"<SA:StructuredAnnotations>")
+    assert sa_stop == roi_start and xml[roi_start:].startswith(b'<ROI ID="ROI:0">')
+    assert xml[roi_stop:].startswith(b"</OME>")
+    assert skeleton == [(0, sa_start), (roi_stop, len(xml))]
+    assert b"<!--" in xml[:sa_start]
+
+
+def test_scan_deferred_sections_nothing_to_defer():
+    assert oxdls.scan_deferred_sections(OMEXML().to_xml().encode("utf-8")) is None
+    latin = LAZY_XML.replace('encoding="UTF-8"', 'encoding="ISO-8859-1"')
+    assert oxdls.scan_deferred_sections(latin.encode("latin-1")) is None
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_lazy_structured_annotations(backend):
+    o = OMEXML(LAZY_XML, lazy=True, backend=backend)
+    assert len(o.root_node) == 1
+    sa = o.structured_annotations()
+    assert sa.node.tag == \
+        "{http://www.openmicroscopy.org/Schemas/SA/2013-06}StructuredAnnotations"
+    assert o.ns["sa"] == "http://www.openmicroscopy.org/Schemas/SA/2013-06"
+    assert len(sa.node) == 1
+    assert [child.tag.split("}")[1] for child in o.root_node] == \
+        ["Image", "StructuredAnnotations"]
+    assert o.roi_count == 2
+    assert [child.tag.split("}")[1] for child in o.root_node] == \
+        ["Image", "StructuredAnnotations", "ROI", "ROI"]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_lazy_matches_eager(backend):
+    eager = OMEXML(LAZY_XML, backend=backend)
+    o = OMEXML(LAZY_XML, lazy=True, backend=backend)
+    assert o.roi(1).ID == "ROI:1"
+    assert str(OMEXML(LAZY_XML, lazy=True, backend=backend)) == str(eager)
+    assert str(o) == str(eager)
+    assert "None" not in str(o)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_stage_track(backend):
+    pixels = make_pixels(backend, sizes=(4, 1, 1))
+    pixels.set_planes(TheZ=range(4), TheC=0, TheT=0,
+                      PositionX=[1.0, 2.0, 3.0, None],
+                      PositionXUnit=["mm", "pixel", None, "nm"],
+                      PositionY=[1.0, 2.0, 3.0, 4.0],
+                      PositionYUnit=["\u00b5m", "um", "reference frame", "m"],
+                      PositionZ=0.5, PositionZUnit="nm")
+    positions, missing = pixels.stage_track()
+    assert missing.tolist() == [[False, False, False], [True, False, False],
+                                [True, True, False], [True, False, False]]
+    assert (np.isnan(positions) == missing).all()
+    assert np.allclose(positions[~missing], [1000.0, 1.0, 0.0005, 2.0, 0.0005,
+                                             0.0005, 4e6, 0.0005])
+    positions, missing = pixels.stage_track("nm")
+    assert np.allclose(positions[0], [1e6, 1000.0, 0.5])
+    with pytest.raises(ValueError):
+        pixels.stage_track("parsec")
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_plane_table(backend):
+    pixels = make_pixels(backend, sizes=(3, 1, 1))
+    pixels.set_planes(TheZ=[0, 1, None], TheC=0, TheT=0, DeltaT=[0.5, None, 1e-3],
+                      DeltaTUnit=["ms", None, "s"])
+    table = pixels.plane_table()
+    assert table["TheZ"].tolist() == [0, 1, -1]
+    assert table["TheC"].tolist() == [0, 0, 0]
+    assert np.isnan(table["DeltaT"][1]) and table["DeltaT"][[0, 2]].tolist() == [0.5, 1e-3]
+    assert table["DeltaTUnit"].tolist() == ["ms", "", "s"]
+    assert np.isnan(table["PositionX"]).all()
+    assert pixels.plane_table(("TheT",)).dtype.names == ("TheT",)
+    pixels.Plane(1).node.set("TheZ", "1.5")
+    with pytest.raises(ValueError):
+        pixels.plane_table()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_check_consistency(backend):
+    o = OMEXML(backend=backend)
+    pixels = o.image().Pixels
+    pixels.SizeZ, pixels.SizeC, pixels.SizeT = SIZES
+    pixels.populate_planes()
+    pixels.tiffdata_count = 1
+    assert o.check_consistency()[0]["Problems"] == []
+    pixels.Plane(0).TheT = 4
+    duplicate = pixels.Plane(1)
+    pixels.Plane(2).TheZ, pixels.Plane(2).TheC, pixels.Plane(2).TheT = \
+        duplicate.TheZ, duplicate.TheC, duplicate.TheT
+    pixels.set_tiffdata(first_z=[0, 0], first_c=0, first_t=[0, 3], ifd=[0, 30],
+                        plane_count=[2, 10])
+    report = o.check_consistency()[0]
+    assert report["PlanesOutOfRange"].tolist() == [0]
+    assert report["DuplicatePlanes"].tolist() == \
+        [[duplicate.TheZ, duplicate.TheC, duplicate.TheT]]
+    assert report["MissingPlanes"] == 2
+    assert report["TiffDataOutOfRange"].tolist() == [1]
+    assert report["UncoveredPlanes"] == 16
+    assert report["OverlappingPlanes"] == 0
+    assert len(report["Problems"]) == 5
+
+
+def probe_document(backend, n_planes=50):
+    o = OMEXML(backend=backend)
+    pixels = o.image().Pixels
+    pixels.SizeX, pixels.SizeY = 64, 32
+    pixels.SizeZ, pixels.SizeC, pixels.SizeT = 1, 1, n_planes
+    pixels.PixelType = "uint16"
+    pixels.populate_planes(DeltaT=np.arange(n_planes) * 0.5)
+    pixels.tiffdata_count = 1
+    return str(o)
+
+
+def assert_probed(result):
+    assert len(result) == 1
+    assert (result[0]["SizeX"], result[0]["SizeY"], result[0]["SizeT"],
+            result[0]["PixelType"]) == (64, 32, 50, "uint16")
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_probe_path(backend, tmp_path):
+    path = tmp_path / "probe.ome.xml"
+    path.write_text(probe_document(backend), encoding="utf-8")
+    assert_probed(oxdls.probe(path, backend))
+    assert_probed(oxdls.probe(str(path), backend))
+
+
+OME_NS = "http://www.openmicroscopy.org/Schemas/OME/2016-06"
+SA_NS = "http://www.openmicroscopy.org/Schemas/SA/2016-06"
+
+SERIALISED_XML = [
+    # default namespace, as written by OMEXML()
+    None,
+    # ome: prefixed, with StructuredAnnotations in their own namespace
+    '<?xml version="1.0"?><ome:OME xmlns:ome="%s" xmlns:sa="%s">'
+    '<ome:Image ID="Image:0" Name="a &amp; b &lt;c&gt;"><ome:AcquisitionDate/>'
+    '<ome:Pixels ID="Pixels:0" SizeX="1"><ome:Plane TheZ="0" PositionXUnit="\u00b5m"/>'
+    '</ome:Pixels></ome:Image><sa:StructuredAnnotations><sa:XMLAnnotation ID="a">'
+    '<sa:Value>v</sa:Value></sa:XMLAnnotation></sa:StructuredAnnotations></ome:OME>'
+    % (OME_NS, SA_NS),
+    # prefixed, with a foreign namespace inside an annotation
+    '<?xml version="1.0"?><ome:OME xmlns:ome="%s" xmlns:sa="%s" xmlns:q="http://q">'
+    '<ome:Image ID="i"><ome:Pixels ID="p" SizeX="1"/></ome:Image>'
+    '<sa:StructuredAnnotations><sa:XMLAnnotation ID="a"><sa:Value><q:x q:y="1">v</q:x>'
+    '</sa:Value></sa:XMLAnnotation></sa:StructuredAnnotations></ome:OME>' % (OME_NS, SA_NS),
+    # default namespace with foreign elements and attributes
+    '<?xml version="1.0"?><OME xmlns="%s" xmlns:x="http://example.org/x">'
+    '<Image ID="i" x:note="t&#9;ab &amp; &lt;&gt;&#10;"><Pixels ID="p" SizeX="1">'
+    '<x:Extra x:a="1"/></Pixels></Image></OME>' % OME_NS,
+    # text needing escapes: a carriage return and empty text
+    '<?xml version="1.0"?><OME xmlns="%s"><Image ID="i" Name="cr&#13;">'
+    '<Description>line&#13;\nend</Description><AcquisitionDate></AcquisitionDate>'
+    '<Pixels ID="p" SizeX="1"/></Image></OME>' % OME_NS,
+]
+
+
+@pytest.mark.skipif(oxdls.lxml_etree is None, reason="lxml is not installed")
+@pytest.mark.parametrize("xml", SERIALISED_XML)
+def test_str_same_for_both_backends(xml):
+    if xml is None:
+        o = OMEXML(backend=oxdls.BACKEND_ETREE)
+        o.image().Pixels.set_planes(TheZ=[0, 1], DeltaT=[1.5, None],
+                                    PositionXUnit="\u00b5m")
+        xml = str(o)
+    expected = str(OMEXML(xml, backend=oxdls.BACKEND_ETREE))
+    assert str(OMEXML(xml, backend=oxdls.BACKEND_LXML)) == expected
+    # and reads back the same with both
+    assert str(OMEXML(expected, backend=oxdls.BACKEND_LXML)) == \
+        str(OMEXML(expected, backend=oxdls.BACKEND_ETREE))
+
+
+@pytest.mark.skipif(oxdls.lxml_etree is None, reason="lxml is not installed")
+@pytest.mark.parametrize("xml", SERIALISED_XML[:2])
+def test_lxml_to_string_writes_natively(xml):
+    expected = str(OMEXML(xml, backend=oxdls.BACKEND_ETREE))
+    # str() has registered the document's prefixes with ElementTree
+    o = OMEXML(xml, backend=oxdls.BACKEND_LXML)
+    o._indent(o.root_node)
+    native = oxdls.lxml_to_string(o.root_node, o.ns["ome"])
+    assert native is not None
+    assert native == expected
+
+
+def expected_probe(xml):
+    '''What probe should find, from the Pixels of a full parse'''
+    o = OMEXML(xml, backend=oxdls.BACKEND_ETREE)
+    results = []
+    for i in range(o.image_count):
+        pixels = o.image(i).Pixels
+        results.append(dict(
+            ID=pixels.ID, DimensionOrder=pixels.DimensionOrder,
+            PixelType=pixels.PixelType, SizeX=pixels.SizeX, SizeY=pixels.SizeY,
+            SizeZ=pixels.SizeZ, SizeC=pixels.SizeC, SizeT=pixels.SizeT,
+            PhysicalSizeX=pixels.PhysicalSizeX, PhysicalSizeY=pixels.PhysicalSizeY,
+            PhysicalSizeZ=pixels.PhysicalSizeZ,
+            PhysicalSizeXUnit=pixels.PhysicalSizeXUnit,
+            PhysicalSizeYUnit=pixels.PhysicalSizeYUnit,
+            PhysicalSizeZUnit=pixels.PhysicalSizeZUnit))
+    return results
+
+
+def probe_documents():
+    xml = probe_document(oxdls.BACKEND_ETREE)
+    yield "default", xml
+    o = OMEXML(xml, backend=oxdls.BACKEND_ETREE)
+    o.image_count = 3
+    o.image(2).Pixels.SizeT = 7
+    o.image(1).Pixels.PhysicalSizeX = 0.25
+    yield "images", str(o)
+    # markup inside Pixels that must not end the skipped range early
+    yield "comment", xml.replace(
+        "<ome:Plane ", "<!-- </ome:Pixels><ome:Image> --><ome:Plane ", 1)
+    yield "cdata", xml.replace(
+        "<ome:TiffData", "<ome:Channel ID=\"Channel:0:0\"><ome:LightPath>"
+        "<![CDATA[</ome:Pixels>]]></ome:LightPath></ome:Channel><ome:TiffData", 1)
+    yield "default namespace", xml.replace("ome:", "").replace(
+        "xmlns:ome=", "xmlns=")
+    yield "self-closing", '<?xml version="1.0"?><OME xmlns="%s"><Image ID="i">' \
+        '<Pixels ID="p" SizeX="3" SizeY="4" SizeZ="1" SizeC="2" SizeT="5" ' \
+        'Type="uint8" DimensionOrder="XYCZT"/></Image><Image ID="j"><Pixels ' \
+        'ID="q" SizeX="1"></Pixels></Image></OME>' % OME_NS
+
+
+PROBE_DOCUMENTS = list(probe_documents())
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("name, xml", PROBE_DOCUMENTS,
+                         ids=[name for name, xml in PROBE_DOCUMENTS])
+def test_probe_sources(backend, name, xml, tmp_path):
+    expected = expected_probe(xml)
+    data = xml.encode("utf-8")
+    assert oxdls.probe(xml, backend) == expected
+    assert oxdls.probe(data, backend) == expected
+    assert oxdls.probe(bytearray(data), backend) == expected
+    assert oxdls.probe(memoryview(data), backend) == expected
+    path = tmp_path / "probe.ome.xml"
+    path.write_bytes(data)
+    with open(str(path), "rb") as fd:
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            assert oxdls.probe(mapped, backend) == expected
+        fd.seek(0)
+        assert oxdls.probe(fd, backend) == expected
+    # a file object that can't be memory-mapped is read in chunks
+    assert oxdls.probe(io.BytesIO(data), backend) == expected
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_probe_latin1(backend):
+    xml = probe_document(oxdls.BACKEND_ETREE).replace('Name="', 'Name="caf\u00e9 ', 1)
+    data = ('<?xml version="1.0" encoding="ISO-8859-1"?>' + xml).encode("latin-1")
+    assert oxdls.probe(data, backend) == expected_probe(data)
+    assert list(oxdls.probe_ranges(data)) == [(0, len(data))]
+
+
+def test_probe_ranges_skip_pixels_children():
+    data = probe_document(oxdls.BACKEND_ETREE).encode("utf-8")
+    ranges = list(oxdls.probe_ranges(data))
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+    kept = b"".join(data[start:stop] for start, stop in ranges)
+    assert b"<ome:Pixels " in kept and b"</ome:Pixels>" in kept
+    assert b"Plane" not in kept and b"TiffData" not in kept
+    assert len(kept) < len(data) // 4
+
+
+def make_tiff(description, byte_order="<", big=False, description_type=2):
+    '''A TIFF whose first IFD has ImageWidth, the description and ImageLength
+
+    The description is written between the header and the IFD, so the
+    IFD offset and the description offset both have to be followed.
+    '''
+    order = b"II" if byte_order == "<" else b"MM"
+    if big:
+        header_size, count_fmt, entry_fmt, inline_size = 16, "Q", "HHQQ", 8
+    else:
+        header_size, count_fmt, entry_fmt, inline_size = 8, "H", "HHII", 4
+    data = description + b"\0"
+    ifd_offset = header_size + len(data) + len(data) % 2
+    if big:
+        header = order + struct.pack(byte_order + "HHHQ", 43, 8, 0, ifd_offset)
+    else:
+        header = order + struct.pack(byte_order + "HI", 42, ifd_offset)
+    if len(data) <= inline_size:
+        value = data.ljust(inline_size, b"\0")
+    else:
+        value = struct.pack(byte_order + entry_fmt[-1], header_size)
+
+    def entry(tag, dtype, count, value):
+        return struct.pack(byte_order + entry_fmt[:3], tag, dtype, count) + value
+
+    short = lambda n: struct.pack(byte_order + "H", n).ljust(inline_size, b"\0")
+    entries = [entry(256, 3, 1, short(64)),
+               entry(270, description_type, len(data), value),
+               entry(257, 3, 1, short(32))]
+    ifd = struct.pack(byte_order + count_fmt, len(entries)) + b"".join(entries) + \
+        struct.pack(byte_order + count_fmt, 0)
+    return header + data.ljust(ifd_offset - header_size, b"\0") + ifd + b"\xff" * 64
+
+
+TIFF_LAYOUTS = [("<", False), (">", False), ("<", True), (">", True)]
+
+
+@pytest.mark.parametrize("byte_order, big", TIFF_LAYOUTS,
+                         ids=["II", "MM", "II-BigTIFF", "MM-BigTIFF"])
+def test_read_tiff_description(byte_order, big, tmp_path):
+    xml = probe_document(oxdls.BACKEND_ETREE).encode("utf-8")
+    tiff = make_tiff(xml, byte_order, big)
+    assert oxdls.read_tiff_description(io.BytesIO(tiff)) == xml
+    path = tmp_path / "image.ome.tif"
+    path.write_bytes(tiff)
+    assert oxdls.read_tiff_description(str(path)) == xml
+    for backend in BACKENDS:
+        o = OMEXML.from_tiff(str(path), backend=backend)
+        assert o.image().Pixels.SizeT == 50
+    # a description short enough to be held in the IFD entry
+    short = b"abc" if big else b"ab"
+    assert oxdls.read_tiff_description(
+        io.BytesIO(make_tiff(short, byte_order, big))) == short
+
+
+@pytest.mark.parametrize("byte_order, big", TIFF_LAYOUTS,
+                         ids=["II", "MM", "II-BigTIFF", "MM-BigTIFF"])
+def test_read_tiff_description_errors(byte_order, big):
+    with pytest.raises(ValueError):
+        oxdls.read_tiff_description(io.BytesIO(make_tiff(
+            b"<OME/>", byte_order, big, description_type=7)))
+    tiff = bytearray(make_tiff(b"<OME/>", byte_order, big))
+    # renumber the ImageDescription tag
+    tag = struct.pack(byte_order + "H", 270)
+    position = tiff.index(tag, 16 if big else 8)
+    tiff[position:position + 2] = struct.pack(byte_order + "H", 305)
+    with pytest.raises(ValueError):
+        oxdls.read_tiff_description(io.BytesIO(bytes(tiff)))
+
+
+def test_read_tiff_description_not_tiff():
+    for data in (b"", b"II", b"GIF89a\0\0", b"II\x2a", b"II\x2b\0\x08\0\0\0"):
+        with pytest.raises(ValueError):
+            oxdls.read_tiff_description(io.BytesIO(data))